@@ -15,6 +15,11 @@ def load_jsonl(path):
         return [json.loads(line) for line in f]
 
 
+def query_text(ex):
+    """Text embedded for retrieval: the context plus the last utterance."""
+    return f"{ex['context']} {ex['speaker']}: {ex['utterance']}"
+
+
 def build_retrieval_corpus(train_data, model, device):
     """
     Build an embedding index from training contexts + utterances.
@@ -24,8 +29,7 @@ def build_retrieval_corpus(train_data, model, device):
     responses = []
 
     for ex in train_data:
-        text = f"{ex['context']} {ex['speaker']}: {ex['utterance']}"
-        corpus_texts.append(text)
+        corpus_texts.append(query_text(ex))
         responses.append(ex["response"])
 
     print(f"Encoding {len(corpus_texts)} training examples for retrieval...")
@@ -39,6 +43,33 @@ def build_retrieval_corpus(train_data, model, device):
     return corpus_embeddings, responses
 
 
+def retrieve_with_scores(test_data, model, corpus_embeddings, responses, device="cuda", batch_size=64):
+    """
+    For each example, return the response of the most similar training
+    example and its cosine similarity.
+    """
+    query_embs = model.encode(
+        [query_text(ex) for ex in test_data],
+        convert_to_tensor=True,
+        device=device,
+        batch_size=batch_size,
+    )
+    cos_scores = util.cos_sim(query_embs, corpus_embeddings)
+    best_scores, best_idx = cos_scores.max(dim=1)
+    return [(responses[int(i)], float(s)) for i, s in zip(best_idx, best_scores)]
+
+
+def retrieve_response(ex, model, corpus_embeddings, responses, device="cuda"):
+    """
+    Return the response of the training example most similar to `ex`.
+    """
+    query_emb = model.encode(query_text(ex), convert_to_tensor=True, device=device)
+    # Compute cosine similarities
+    cos_scores = util.cos_sim(query_emb, corpus_embeddings)[0]
+    best_idx = int(torch.argmax(cos_scores))
+    return responses[best_idx]
+
+
 def predict_retrieval(train_data, test_data, model, corpus_embeddings, responses, device="cuda"):
     """
     For each test example, find the most similar training example
@@ -47,12 +78,7 @@ def predict_retrieval(train_data, test_data, model, corpus_embeddings, responses
     predictions = []
 
     for ex in tqdm(test_data, desc="Retrieving"):
-        query_text = f"{ex['context']} {ex['speaker']}: {ex['utterance']}"
-        query_emb = model.encode(query_text, convert_to_tensor=True, device=device)
-        # Compute cosine similarities
-        cos_scores = util.cos_sim(query_emb, corpus_embeddings)[0]
-        best_idx = int(torch.argmax(cos_scores))
-        best_response = responses[best_idx]
+        best_response = retrieve_response(ex, model, corpus_embeddings, responses, device)
 
         predictions.append({
             "mission": ex.get("mission", ""),
@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from pathlib import Path
+from src.generation.response_cache import weights_fingerprint
+
+# peft's name for "no adapter" rows in a mixed-adapter batch.
+BASE_ADAPTER = "__base__"
+
+
+def adapter_name(character):
+    """
+    Adapter name for a character, matching train_lora's output directories
+    ("Arthur Morgan" -> "arthur_morgan").
+    """
+    return character.strip().lower().replace(" ", "_")
+
+
+class AdapterRegistry:
+    """
+    One resident base model serving several LoRA adapters trained by
+    src/personality/train_lora.py. Adapters are loaded on first use and the
+    least recently used ones are unloaded when more than `max_loaded` are
+    resident or their weights exceed `max_bytes`. Rows of a batch can use
+    different adapters via peft's `adapter_names` forward argument.
+    """
+    def __init__(self, base_model, adapter_paths=None, max_loaded=None, max_bytes=None):
+        self.base_model = base_model
+        self.model = None
+        self.paths = dict(adapter_paths or {})
+        self.max_loaded = max_loaded
+        self.max_bytes = max_bytes
+        self._loaded = OrderedDict()
+        self._fingerprints = {}
+        self.loads = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_directory(cls, base_model, adapters_dir, **kwargs):
+        """
+        Registers every subdirectory of `adapters_dir` that holds a saved
+        adapter, named after the directory.
+        """
+        paths = {
+            p.name: str(p) for p in sorted(Path(adapters_dir).iterdir())
+            if (p / "adapter_config.json").exists()
+        }
+        return cls(base_model, paths, **kwargs)
+
+    def register(self, name, path):
+        self.paths[name] = path
+
+    def cache_id(self, name):
+        """
+        Identifies adapter `name` and its current weights in response cache
+        keys, so an adapter retrained in place does not reuse old responses.
+        """
+        if name is None or name == BASE_ADAPTER or name not in self.paths:
+            return name
+        if name not in self._fingerprints:
+            self._fingerprints[name] = weights_fingerprint(self.paths[name])
+        return f"{name}@{self._fingerprints[name]}"
+
+    def loaded(self):
+        return list(self._loaded)
+
+    def prepare(self, name, in_use=()):
+        """
+        Makes sure adapter `name` is resident, evicting idle adapters if the
+        budget requires it. Adapters in `in_use` are never evicted. Returns
+        the name to pass as `adapter_names` for this request's rows.
+        """
+        if name is None or name == BASE_ADAPTER:
+            self._ensure_model()
+            return BASE_ADAPTER
+        if name not in self.paths:
+            raise KeyError(f"Unknown adapter '{name}'")
+
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+        else:
+            self._load(name)
+        # Adapters pinned by running rows may have kept the registry over
+        # budget; they are dropped here once idle.
+        self._evict(keep=set(in_use) | {name})
+        return name
+
+    def adapter_bytes(self, name):
+        marker = f".{name}."
+        return sum(
+            p.numel() * p.element_size()
+            for n, p in self.model.named_parameters()
+            if marker in n
+        )
+
+    def _ensure_model(self):
+        if self.model is None:
+            raise RuntimeError("No adapter has been loaded onto the base model yet")
+
+    def _load(self, name):
+        from peft import PeftModel
+
+        # Fingerprint what is actually loaded, in case it changed on disk.
+        self._fingerprints[name] = weights_fingerprint(self.paths[name])
+        if self.model is None:
+            self.model = PeftModel.from_pretrained(self.base_model, self.paths[name], adapter_name=name)
+            self.model.eval()
+        else:
+            self.model.load_adapter(self.paths[name], adapter_name=name)
+        self._loaded[name] = self.adapter_bytes(name)
+        self.loads += 1
+
+    def _evict(self, keep):
+        def over_budget():
+            too_many = self.max_loaded is not None and len(self._loaded) > self.max_loaded
+            too_big = self.max_bytes is not None and sum(self._loaded.values()) > self.max_bytes
+            return too_many or too_big
+
+        for name in list(self._loaded):
+            if not over_budget():
+                break
+            if name in keep:
+                continue
+            self.model.delete_adapter(name)
+            del self._loaded[name]
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "loaded": list(self._loaded),
+            "bytes": sum(self._loaded.values()),
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
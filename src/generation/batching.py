@@ -0,0 +1,117 @@
+import torch
+from src.generation.prefix_cache import generate_with_prefix, split_prefix
+from src.generation.stopping import truncate_at_stop
+
+MAX_BATCH_TOKENS = 8192
+BUCKET_WIDTH = 64
+
+
+def bucket_batches(lengths, max_batch_tokens=MAX_BATCH_TOKENS, max_batch_size=None,
+                   reserve_tokens=0, bucket_width=BUCKET_WIDTH):
+    """
+    Groups item indices into batches of similar length. Items are sorted into
+    buckets of `bucket_width` tokens and batches are filled while
+    rows * (longest row + reserve_tokens) stays within `max_batch_tokens`,
+    so short prompts are not padded to the length of long ones. An item that
+    is over budget on its own still gets a batch of one.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: (lengths[i] // bucket_width, lengths[i]))
+    batches = []
+    batch, longest = [], 0
+    for i in order:
+        bucket_changed = batch and lengths[i] // bucket_width != lengths[batch[0]] // bucket_width
+        width = max(longest, lengths[i]) + reserve_tokens
+        too_big = (len(batch) + 1) * width > max_batch_tokens
+        too_many = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (bucket_changed or too_big or too_many):
+            batches.append(batch)
+            batch, longest = [], 0
+        batch.append(i)
+        longest = max(longest, lengths[i])
+    if batch:
+        batches.append(batch)
+    return batches
+
+def left_pad(sequences, pad_id, device=None):
+    """
+    Left-pads lists of token ids into (input_ids, attention_mask) tensors, as
+    decoder-only generation expects the last real token in the final column.
+    """
+    width = max(len(s) for s in sequences)
+    input_ids = torch.tensor([[pad_id] * (width - len(s)) + list(s) for s in sequences], device=device)
+    attention_mask = torch.tensor([[0] * (width - len(s)) + [1] * len(s) for s in sequences], device=device)
+    return input_ids, attention_mask
+
+def generate_batched(
+        model,
+        tokenizer,
+        prompts,
+        max_new_tokens=120,
+        max_batch_tokens=MAX_BATCH_TOKENS,
+        max_length=None,
+        prefix=None,
+        prefix_cache=None,
+        stop_sequences=None,
+        **generate_kwargs
+    ):
+    """
+    Runs model.generate over `prompts` in length-bucketed, left-padded
+    batches formed by token budget and returns the decoded outputs in the
+    original prompt order. Prompts that start with `prefix` are batched
+    separately and reuse its KV states from `prefix_cache`. Each row stops
+    decoding as soon as it produces one of `stop_sequences`, which are cut
+    from the output.
+    """
+    outputs = [None] * len(prompts)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    if stop_sequences:
+        generate_kwargs = dict(generate_kwargs, stop_strings=list(stop_sequences), tokenizer=tokenizer)
+
+    shared = {}
+    if prefix is not None and prefix_cache is not None:
+        for i, prompt in enumerate(prompts):
+            suffix = split_prefix(tokenizer, prompt, prefix)
+            if suffix is not None:
+                shared[i] = tokenizer(suffix, add_special_tokens=False)["input_ids"]
+
+    if shared:
+        indices = list(shared)
+        prefix_len = len(tokenizer(prefix)["input_ids"])
+        lengths = [prefix_len + len(shared[i]) for i in indices]
+        for batch in bucket_batches(lengths, max_batch_tokens, reserve_tokens=max_new_tokens):
+            rows = [indices[b] for b in batch]
+            with torch.inference_mode():
+                generated = generate_with_prefix(
+                    model, tokenizer, prefix,
+                    [prompts[i][len(prefix):] for i in rows],
+                    prefix_cache,
+                    max_new_tokens=max_new_tokens,
+                    **generate_kwargs
+                )
+            for i, ids in zip(rows, generated):
+                outputs[i] = tokenizer.decode(ids, skip_special_tokens=True)
+
+    rest = [i for i in range(len(prompts)) if i not in shared]
+    if rest:
+        encoded = tokenizer(
+            [prompts[i] for i in rest],
+            truncation=max_length is not None,
+            max_length=max_length
+        )["input_ids"]
+        for batch in bucket_batches([len(e) for e in encoded], max_batch_tokens, reserve_tokens=max_new_tokens):
+            input_ids, attention_mask = left_pad([encoded[b] for b in batch], pad_id, model.device)
+            with torch.inference_mode():
+                output_ids = model.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    max_new_tokens=max_new_tokens,
+                    pad_token_id=pad_id,
+                    **generate_kwargs
+                )
+            decoded = tokenizer.batch_decode(output_ids[:, input_ids.shape[1]:], skip_special_tokens=True)
+            for b, text in zip(batch, decoded):
+                outputs[rest[b]] = text
+
+    if stop_sequences:
+        outputs = [truncate_at_stop(text, stop_sequences) for text in outputs]
+    return [text.strip() for text in outputs]
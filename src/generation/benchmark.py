@@ -0,0 +1,224 @@
+import argparse
+import json
+import platform
+import resource
+import time
+from itertools import product
+from pathlib import Path
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from src.generation.cpu_backend import configure_threads, quantize
+from src.generation.engine import GenerationEngine
+from src.generation.stopping import dialogue_stop_sequences
+from src.util.build_prompt import build_prompt, build_prompt_prefixes
+
+MODEL_PATH = "models/lora_adapters/arthur_morgan"
+TEST_DATA_PATH = "data/summarized_splits/dialogue_pairs_test_summarized.jsonl"
+OUTPUT_PATH = "results/benchmarks/generation.json"
+NUM_EXAMPLES = 64
+TINY_MODEL = "tiny"
+DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+# CPU weight quantization from cpu_backend; the model itself runs in float32.
+QUANTIZED_DTYPES = ("int8", "int4")
+
+
+def load_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def build_tiny_model(texts, vocab_size=1000):
+    """
+    A randomly initialized two-layer Qwen2 model with a byte-level BPE
+    tokenizer trained on `texts`. Its outputs are meaningless, but it runs
+    every part of the generation path in seconds on a CPU, which is enough to
+    catch latency and memory regressions without downloading weights.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    bpe.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, eos_token="<|endoftext|>")
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+
+    config = Qwen2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        tie_word_embeddings=True,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(0)
+    return tokenizer, Qwen2ForCausalLM(config).eval()
+
+def load_benchmark_model(model_path, dtype, examples):
+    if model_path == TINY_MODEL:
+        tokenizer, model = build_tiny_model([build_prompt(ex) for ex in examples])
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            dtype=torch.float32 if dtype in QUANTIZED_DTYPES else DTYPES[dtype]
+        ).eval()
+
+    if dtype in QUANTIZED_DTYPES:
+        model = quantize(model, dtype)
+    else:
+        model = model.to(DTYPES[dtype])
+    return tokenizer, model.to("cuda" if torch.cuda.is_available() and dtype not in QUANTIZED_DTYPES else "cpu")
+
+def fit_prompt(tokenizer, prompt, prompt_length):
+    """
+    Returns `prompt` resized to about `prompt_length` tokens (None keeps it
+    as built). Long prompts lose their start; short ones are extended by
+    repeating their own tokens in front, so the dialogue turn and response
+    cue always stay at the end.
+    """
+    if prompt_length is None:
+        return prompt
+    ids = tokenizer(prompt, add_special_tokens=False)["input_ids"]
+    while len(ids) < prompt_length:
+        ids = ids + ids
+    return tokenizer.decode(ids[-prompt_length:])
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(np.mean(values))}
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if platform.system() == "Darwin" else rss * 1024
+
+def run_config(model, tokenizer, examples, batch_size, prompt_length, max_new_tokens, temperature):
+    """
+    Streams every example through a GenerationEngine, `batch_size` requests
+    at a time, and measures per-request latency and overall throughput.
+    """
+    engine = GenerationEngine(model, tokenizer, max_batch_size=batch_size, max_length=4096,
+                              max_new_tokens=max_new_tokens, temperature=temperature)
+    stats = []
+    start = time.perf_counter()
+    with engine:
+        for i in range(0, len(examples), batch_size):
+            streams = [
+                engine.stream(
+                    fit_prompt(tokenizer, build_prompt(ex), prompt_length),
+                    prefixes=build_prompt_prefixes(ex) if prompt_length is None else (),
+                    stop_sequences=dialogue_stop_sequences(ex)
+                )
+                for ex in examples[i:i + batch_size]
+            ]
+            for stream in streams:
+                stream.text()
+                stats.append(stream.stats())
+    seconds = time.perf_counter() - start
+
+    generated = sum(s["generated_tokens"] for s in stats)
+    return {
+        "batch_size": batch_size,
+        "prompt_length": prompt_length,
+        "requests": len(stats),
+        "mean_prompt_tokens": sum(s["prompt_tokens"] for s in stats) / len(stats),
+        "generated_tokens": generated,
+        "seconds": seconds,
+        "tokens_per_second": generated / seconds if seconds else 0.0,
+        "latency": percentiles([s["total_time"] for s in stats]),
+        "time_to_first_token": percentiles([s["time_to_first_token"] for s in stats if s["time_to_first_token"] is not None]),
+        "inter_token_latency": percentiles([t for s in stats for t in s["inter_token_latencies"]]),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "peak_cuda_bytes": torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None,
+    }
+
+def run_benchmark(model_path, examples, batch_sizes=(1, 8), prompt_lengths=(None,), dtypes=("float32",),
+                  max_new_tokens=120, temperature=0.7, num_threads=None):
+    """
+    Benchmarks every combination of dtype, batch size and prompt length.
+    Peak RSS is the process high-water mark, so it only grows from one
+    configuration to the next; compare it across runs of the same sweep.
+    """
+    report = {
+        "model": model_path,
+        "examples": len(examples),
+        "max_new_tokens": max_new_tokens,
+        "temperature": temperature,
+        "threads": configure_threads(num_threads),
+        "device": "cuda" if torch.cuda.is_available() else "cpu",
+        "torch": torch.__version__,
+        "results": [],
+    }
+    for dtype in dtypes:
+        tokenizer, model = load_benchmark_model(model_path, dtype, examples)
+        # One short warm-up request so lazy initialization is not timed.
+        run_config(model, tokenizer, examples[:1], 1, None, 2, temperature)
+        for batch_size, prompt_length in product(batch_sizes, prompt_lengths):
+            result = run_config(model, tokenizer, examples, batch_size, prompt_length, max_new_tokens, temperature)
+            report["results"].append({"dtype": dtype, **result})
+            print(f"{dtype} batch={batch_size} prompt={prompt_length or 'as built'}: "
+                  f"p50 {result['latency']['p50']:.3f}s p95 {result['latency']['p95']:.3f}s "
+                  f"p99 {result['latency']['p99']:.3f}s, TTFT p50 {result['time_to_first_token']['p50']:.3f}s, "
+                  f"{result['tokens_per_second']:.1f} tok/s, peak RSS {result['peak_rss_bytes'] / 2**20:.0f} MiB")
+        del model
+    return report
+
+def parse_list(value, cast=int):
+    return [None if v == "none" else cast(v) for v in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and throughput benchmark for the generation engine.")
+    parser.add_argument("--model", default=MODEL_PATH,
+                        help=f"Model directory, or '{TINY_MODEL}' for a small random Qwen2 model.")
+    parser.add_argument("--data", default=TEST_DATA_PATH)
+    parser.add_argument("--num-examples", type=int, default=NUM_EXAMPLES)
+    parser.add_argument("--batch-sizes", default="1,8", help="Comma-separated, e.g. 1,4,8.")
+    parser.add_argument("--prompt-lengths", default="none",
+                        help="Comma-separated prompt token counts; 'none' keeps prompts as built.")
+    parser.add_argument("--dtypes", default="float32",
+                        help=f"Comma-separated from {', '.join([*DTYPES, *QUANTIZED_DTYPES])}.")
+    parser.add_argument("--max-new-tokens", type=int, default=120)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--output", default=OUTPUT_PATH)
+    args = parser.parse_args()
+
+    examples = load_jsonl(args.data)[:args.num_examples]
+    report = run_benchmark(
+        args.model,
+        examples,
+        batch_sizes=parse_list(args.batch_sizes),
+        prompt_lengths=parse_list(args.prompt_lengths),
+        dtypes=parse_list(args.dtypes, str),
+        max_new_tokens=args.max_new_tokens,
+        temperature=args.temperature,
+        num_threads=args.threads
+    )
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+    print(f"Saved benchmark to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import torch
+from transformers import DynamicCache
+
+
+def cache_to_tensors(cache):
+    """
+    Returns the per-layer (keys, values) tensors held by a HF cache object.
+    """
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+def tensors_to_cache(kv, config=None):
+    """
+    Builds a fresh DynamicCache from per-layer (keys, values) tensors. The
+    tensors are not modified by later decoding, so they can be shared.
+    """
+    cache = DynamicCache(config=config) if config is not None else DynamicCache()
+    for layer_idx, (keys, values) in enumerate(kv):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+def left_pad_kv(kv, mask, length):
+    """
+    Left-pads a batch of KV tensors and its attention mask to `length` positions.
+    """
+    pad = length - mask.shape[1]
+    if pad <= 0:
+        return kv, mask
+    padded = []
+    for keys, values in kv:
+        shape = list(keys.shape)
+        shape[2] = pad
+        padded.append((
+            torch.cat([keys.new_zeros(shape), keys], dim=2),
+            torch.cat([values.new_zeros(shape), values], dim=2),
+        ))
+    mask = torch.cat([mask.new_zeros((mask.shape[0], pad)), mask], dim=1)
+    return padded, mask
+
+def kv_nbytes(kv):
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+def crop_cache(cache, length):
+    """
+    Drops cached positions beyond `length` in place.
+    """
+    excess = cache.get_seq_length() - length
+    if excess > 0:
+        cache.crop(-excess)
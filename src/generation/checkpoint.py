@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# Fields that identify a dialogue example independently of its position.
+KEY_FIELDS = ("mission", "context", "speaker", "utterance", "response_speaker")
+
+
+def example_key(example):
+    """
+    Stable hash of an example's identifying fields, used to recognise work
+    that is already done across restarts and shards.
+    """
+    fields = {k: example.get(k, "") for k in KEY_FIELDS}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+def shard_path(output_path, shard_index, num_shards):
+    path = Path(output_path)
+    return str(path.with_name(f"{path.stem}.shard-{shard_index:02d}-of-{num_shards:02d}{path.suffix}"))
+
+def atomic_write_jsonl(path, records):
+    """
+    Writes records to a temporary file next to `path` and renames it into
+    place, so readers never see a half-written file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Per process, as two workers may write the same unit after a lease takeover.
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class PredictionLog:
+    """
+    Append-only JSONL log of finished predictions, each tagged with its
+    `example_key`. Reopening the log recovers what is done; a line cut off
+    by a crash is dropped so the example is simply redone.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.done = {}
+        self._recover()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _recover(self):
+        if not self.path.exists():
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("utf-8").splitlines():
+            if line.strip():
+                record = json.loads(line)
+                self.done[record["example_key"]] = record
+        if end < len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def append(self, records):
+        """
+        Appends a batch of records with a single write and forces it to disk.
+        """
+        if not records:
+            return
+        self._file.write("".join(json.dumps(r) + "\n" for r in records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        for record in records:
+            self.done[record["example_key"]] = record
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def merge_predictions(log_paths, examples, output_path):
+    """
+    Merges prediction logs (e.g. one per shard) into `output_path` in the
+    order of `examples`. Returns the number of examples with no prediction
+    yet; those are left out of the merged file.
+    """
+    done = {}
+    for path in log_paths:
+        if Path(path).exists():
+            with PredictionLog(path) as log:
+                done.update(log.done)
+
+    ordered, missing = [], 0
+    for ex in examples:
+        record = done.get(example_key(ex))
+        if record is None:
+            missing += 1
+        else:
+            ordered.append(record)
+    atomic_write_jsonl(output_path, ordered)
+    return missing
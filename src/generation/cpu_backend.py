@@ -0,0 +1,222 @@
+import json
+import os
+import time
+from pathlib import Path
+import torch
+import torch.nn as nn
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from src.evaluation.bleu import compute_bleu
+from src.generation.engine import GenerationEngine
+from src.generation.stopping import dialogue_stop_sequences
+from src.util.build_prompt import build_prompt
+
+MODEL_PATH = "models/lora_adapters/arthur_morgan"
+TEST_DATA_PATH = "data/summarized_splits/dialogue_pairs_test_summarized.jsonl"
+OUTPUT_PATH = "results/benchmarks/cpu_quantization.json"
+NUM_EXAMPLES = 64
+INT4_GROUP_SIZE = 128
+
+
+def configure_threads(num_threads=None):
+    """
+    Pins PyTorch to one intra-op thread per usable core. Inter-op threads add
+    nothing for a single decode loop and compete with the intra-op pool.
+    """
+    if num_threads is None:
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before the first parallel region runs.
+        pass
+    return num_threads
+
+
+class Int4WeightOnlyLinear(nn.Module):
+    """
+    Linear layer with 4-bit group-wise quantized weights (one scale and zero
+    point per group), multiplied by PyTorch's packed int4 CPU kernel so no
+    float weight is ever materialized. The kernel computes in bfloat16.
+    """
+    def __init__(self, linear, group_size=INT4_GROUP_SIZE):
+        super().__init__()
+        weight = linear.weight.detach().float()
+        self.out_features, self.in_features = weight.shape
+        self.group_size = group_size
+
+        groups = weight.view(self.out_features, -1, group_size)
+        w_min = groups.amin(dim=-1)
+        scale = ((groups.amax(dim=-1) - w_min) / 15).clamp(min=1e-8)
+        q = ((groups - w_min[..., None]) / scale[..., None]).round().clamp(0, 15).to(torch.int32)
+
+        self.register_buffer("packed", torch.ops.aten._convert_weight_to_int4pack_for_cpu(
+            q.view(self.out_features, self.in_features), 1))
+        # The kernel dequantizes a value as (q - 8) * scale + zero.
+        zeros = w_min + 8 * scale
+        self.register_buffer("scales_and_zeros", torch.stack([scale, zeros], dim=-1).transpose(0, 1)
+                             .contiguous().to(torch.bfloat16))
+        self.register_buffer("bias", None if linear.bias is None else linear.bias.detach().clone())
+
+    @classmethod
+    def supports(cls, linear, group_size=INT4_GROUP_SIZE):
+        return linear.in_features % group_size == 0
+
+    def forward(self, x):
+        out = torch.ops.aten._weight_int4pack_mm_for_cpu(
+            x.reshape(-1, self.in_features).to(torch.bfloat16), self.packed, self.group_size,
+            self.scales_and_zeros,
+        )
+        out = out.view(*x.shape[:-1], self.out_features).to(x.dtype)
+        return out if self.bias is None else out + self.bias
+
+
+def quantizable_linears(model):
+    """
+    Names of the model's Linear layers worth quantizing: all but those that
+    share their weight with an embedding (a tied lm_head). Quantizing a tied
+    head would keep the fp32 embedding resident anyway and add a second
+    copy of the largest matrix.
+    """
+    embeddings = {m.weight.data_ptr() for m in model.modules() if isinstance(m, nn.Embedding)}
+    return [
+        name for name, m in model.named_modules()
+        if isinstance(m, nn.Linear) and m.weight.data_ptr() not in embeddings
+    ]
+
+def quantize_int4(model, group_size=INT4_GROUP_SIZE):
+    for name in quantizable_linears(model):
+        parent, _, child_name = name.rpartition(".")
+        module = model.get_submodule(parent)
+        linear = getattr(module, child_name)
+        # Layers the kernel cannot group evenly stay in fp32.
+        if Int4WeightOnlyLinear.supports(linear, group_size):
+            setattr(module, child_name, Int4WeightOnlyLinear(linear, group_size))
+    return model
+
+def quantize(model, quantization):
+    """
+    Applies CPU weight quantization in place: "int8" uses PyTorch dynamic
+    quantization (int8 weights, activations quantized per batch), "int4"
+    uses Int4WeightOnlyLinear. Both multiply with integer kernels. A tied
+    lm_head is left in fp32. None leaves the fp32 model untouched.
+    """
+    if quantization is None:
+        return model
+    if quantization == "int8":
+        # Deprecated, but still core PyTorch's only int8 GEMM path on CPU.
+        qconfig = torch.ao.quantization.default_dynamic_qconfig
+        return torch.ao.quantization.quantize_dynamic(
+            model, {name: qconfig for name in quantizable_linears(model)}, inplace=True,
+        )
+    if quantization == "int4":
+        return quantize_int4(model)
+    raise ValueError(f"Unknown quantization '{quantization}', expected 'int8', 'int4' or None")
+
+def load_cpu_model(model_path=MODEL_PATH, quantization="int8", num_threads=None):
+    """
+    Loads a model for CPU serving. A LoRA adapter directory is loaded on top
+    of its base model and merged, so quantization covers the adapted weights
+    and decoding pays no adapter overhead.
+    """
+    from peft import PeftConfig, PeftModel
+
+    configure_threads(num_threads)
+
+    adapter_config = Path(model_path) / "adapter_config.json"
+    if adapter_config.exists():
+        base_path = PeftConfig.from_pretrained(model_path).base_model_name_or_path
+        model = AutoModelForCausalLM.from_pretrained(base_path, dtype=torch.float32)
+        model = PeftModel.from_pretrained(model, model_path).merge_and_unload()
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_path, dtype=torch.float32)
+    model.eval()
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+
+    return tokenizer, quantize(model, quantization)
+
+def model_nbytes(model):
+    """
+    Size of the model's weights: parameters, buffers (which hold int4
+    weights) and the packed weights of dynamically quantized layers, which
+    are neither. Tied tensors are counted once.
+    """
+    tensors = [*model.parameters(), *model.buffers()]
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            tensors += [t for t in module._weight_bias() if t is not None]
+    return sum({t.data_ptr(): t.numel() * t.element_size() for t in tensors}.values())
+
+
+def load_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def generate_greedy(model, tokenizer, examples):
+    """
+    Greedy predictions for `examples` and the decode throughput in tokens/sec.
+    """
+    engine = GenerationEngine(model, tokenizer, max_batch_size=8, max_length=1024,
+                              max_new_tokens=120, temperature=0.0)
+    start = time.perf_counter()
+    with engine:
+        futures = [
+            engine.submit(build_prompt(ex), stop_sequences=dialogue_stop_sequences(ex))
+            for ex in examples
+        ]
+        outputs = [f.result() for f in futures]
+    seconds = time.perf_counter() - start
+    tokens = sum(len(tokenizer(o, add_special_tokens=False)["input_ids"]) for o in outputs)
+    return outputs, tokens / seconds
+
+def compare_to_fp32(examples, model_path=MODEL_PATH, quantizations=("int8", "int4")):
+    """
+    Runs the fp32 model and each quantized variant greedily on the same
+    examples and reports agreement with the fp32 outputs, weight memory and
+    tokens/sec.
+    """
+    tokenizer, model = load_cpu_model(model_path, quantization=None)
+    reference, fp32_tps = generate_greedy(model, tokenizer, examples)
+    fp32_bytes = model_nbytes(model)
+    report = {"examples": len(examples), "threads": torch.get_num_threads(), "fp32": {
+        "weight_bytes": fp32_bytes,
+        "tokens_per_second": fp32_tps,
+    }}
+    del model
+
+    for quantization in quantizations:
+        _, model = load_cpu_model(model_path, quantization=quantization)
+        outputs, tps = generate_greedy(model, tokenizer, examples)
+        bleu = compute_bleu(outputs, reference)
+        report[quantization] = {
+            "weight_bytes": model_nbytes(model),
+            "memory_reduction": fp32_bytes / model_nbytes(model),
+            "tokens_per_second": tps,
+            "speedup": tps / fp32_tps if fp32_tps else 0.0,
+            "exact_match_with_fp32": sum(o == r for o, r in zip(outputs, reference)) / len(examples),
+            "bleu_vs_fp32": sum(bleu) / len(bleu),
+        }
+        del model
+
+    return report
+
+def main():
+    examples = load_jsonl(TEST_DATA_PATH)[:NUM_EXAMPLES]
+    report = compare_to_fp32(examples)
+
+    Path(OUTPUT_PATH).parent.mkdir(parents=True, exist_ok=True)
+    with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+
+    for name in ("int8", "int4"):
+        r = report[name]
+        print(f"{name}: {r['memory_reduction']:.1f}x smaller, {r['speedup']:.2f}x tokens/sec, "
+              f"exact match {r['exact_match_with_fp32']:.3f}, BLEU vs fp32 {r['bleu_vs_fp32']:.3f}")
+    print(f"Saved quantization report to {OUTPUT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import torch
+from src.generation.cache_utils import cache_to_tensors, tensors_to_cache, left_pad_kv
+from src.generation.prefix_cache import prefix_boundaries
+from src.generation.response_cache import cacheable
+from src.generation.stopping import find_stop, stop_holdback
+
+
+def sample_next_tokens(logits, temperature, top_p, generators=None):
+    """
+    Samples one token per row with per-row temperature and nucleus (top-p)
+    filtering. Rows with temperature <= 0 are decoded greedily. Rows with a
+    torch.Generator in `generators` draw from it, so a seeded request
+    samples the same tokens whatever else is in the batch.
+    """
+    greedy = logits.argmax(dim=-1)
+    probs = torch.softmax(logits.float() / temperature.clamp(min=1e-5).unsqueeze(-1), dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    outside_nucleus = sorted_probs.cumsum(dim=-1) - sorted_probs > top_p.unsqueeze(-1)
+    sorted_probs = sorted_probs.masked_fill(outside_nucleus, 0.0)
+    if generators is None or all(g is None for g in generators):
+        choice = torch.multinomial(sorted_probs, 1)
+    else:
+        choice = torch.cat([
+            torch.multinomial(row[None], 1, generator=g) for row, g in zip(sorted_probs, generators)
+        ])
+    sampled = sorted_idx.gather(-1, choice).squeeze(-1)
+    return torch.where(temperature > 0, sampled, greedy)
+
+
+_STREAM_END = object()
+
+
+class GenerationRequest:
+    def __init__(self, prompt, max_new_tokens, temperature, top_p, stream=False, prefixes=(),
+                 stop_sequences=(), adapter=None, seed=None):
+        self.prompt = prompt
+        self.prefixes = prefixes
+        self.stop_sequences = stop_sequences
+        self.adapter = adapter
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.seed = seed
+        # Created on the sampling device at the first step.
+        self.generator = None
+        self.input_ids = None
+        self.generated = []
+        self.text = ""
+        self.stopped = False
+        self.cancelled = False
+        self.cache_key = None
+        self.future = Future()
+
+        # Text pieces are pushed here as they are decoded when streaming.
+        self.stream = queue.Queue() if stream else None
+        self.emitted_chars = 0
+
+        self.submitted_at = time.perf_counter()
+        self.admitted_at = None
+        self.token_times = []
+        self.finished_at = None
+
+    def cancel(self):
+        """
+        Stops generation for this request. A queued request is dropped; a
+        running one leaves the batch after the current step and resolves to
+        the text generated so far.
+        """
+        self.cancelled = True
+        self.future.cancel()
+
+    def stats(self):
+        """
+        Latency measurements for this request, in seconds.
+        """
+        ttft = self.token_times[0] - self.submitted_at if self.token_times else None
+        itl = [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+        return {
+            "prompt_tokens": len(self.input_ids) if self.input_ids is not None else 0,
+            "generated_tokens": len(self.generated),
+            "queue_time": self.admitted_at - self.submitted_at if self.admitted_at else None,
+            "time_to_first_token": ttft,
+            "inter_token_latencies": itl,
+            "mean_inter_token_latency": sum(itl) / len(itl) if itl else None,
+            "total_time": self.finished_at - self.submitted_at if self.finished_at else None,
+        }
+
+
+class TokenStream:
+    """
+    Iterator over the text pieces of one streamed request. `stats()` reports
+    time-to-first-token and inter-token latency once iteration is done.
+    """
+    def __init__(self, request):
+        self.request = request
+
+    def __iter__(self):
+        while True:
+            piece = self.request.stream.get()
+            if piece is _STREAM_END:
+                break
+            yield piece
+        error = self.request.future.exception()
+        if error is not None:
+            raise error
+
+    def text(self):
+        return self.request.future.result()
+
+    def cancel(self):
+        self.request.cancel()
+
+    def stats(self):
+        return self.request.stats()
+
+
+class GenerationEngine:
+    """
+    Keeps a causal LM resident and serves generation requests with continuous
+    batching. Requests are prefilled as soon as a decode slot is free and join
+    the running batch; finished sequences leave the batch after the step that
+    completed them instead of waiting for the slowest row.
+    """
+    def __init__(
+            self,
+            model,
+            tokenizer,
+            max_batch_size=8,
+            max_length=1024,
+            max_new_tokens=120,
+            temperature=0.7,
+            top_p=0.9,
+            prefix_cache=None,
+            max_batch_tokens=None,
+            stop_sequences=(),
+            adapters=None,
+            response_cache=None,
+            model_id=None,
+            seed=None
+        ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_length = max_length
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.prefix_cache = prefix_cache
+        self.stop_sequences = stop_sequences
+        self.adapters = adapters
+        self.response_cache = response_cache
+        self.seed = seed
+        self.model_id = model_id or getattr(model, "name_or_path", None)
+
+        eos = model.generation_config.eos_token_id
+        eos = eos if isinstance(eos, (list, tuple)) else [eos]
+        self.eos_token_ids = {t for t in [*eos, tokenizer.eos_token_id] if t is not None}
+
+        self._waiting = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        # Running batch: one entry per row, plus the left-padded KV cache,
+        # its attention mask and the next token each row still has to feed.
+        self._running = []
+        self._kv = None
+        self._mask = None
+        self._next_tokens = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._loop, name="generation-engine", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def submit(self, prompt, **options):
+        """
+        Queues a prompt for generation and returns a Future resolving to the
+        generated text.
+
+        Options override the engine defaults per request: max_new_tokens,
+        temperature, top_p, stop_sequences (the request leaves the batch as
+        soon as its text contains one; the stop string is not returned),
+        prefixes (string prefixes of the prompt worth keeping in the prefix
+        cache, see build_prompt_prefixes) and adapter (LoRA adapter name when
+        the engine serves an AdapterRegistry) and seed (sampling seed; the
+        engine default is unseeded).
+
+        With a response_cache, greedy or seeded requests that were answered
+        before resolve immediately without touching the model.
+        """
+        return self._enqueue(prompt, **options).future
+
+    def submit_request(self, prompt, **options):
+        """
+        Like submit(), but returns the GenerationRequest itself, for callers
+        that need its partial text, timings or cancel() while it runs.
+        """
+        return self._enqueue(prompt, **options)
+
+    def stream(self, prompt, **options):
+        """
+        Queues a prompt and returns a TokenStream that yields decoded text
+        pieces as soon as the engine produces them. Takes the same options as
+        submit().
+        """
+        return TokenStream(self._enqueue(prompt, stream=True, **options))
+
+    def _enqueue(self, prompt, stream=False, max_new_tokens=None, temperature=None, top_p=None,
+                 stop_sequences=None, prefixes=(), adapter=None, seed=None):
+        request = GenerationRequest(
+            prompt,
+            max_new_tokens=self.max_new_tokens if max_new_tokens is None else max_new_tokens,
+            temperature=self.temperature if temperature is None else temperature,
+            top_p=self.top_p if top_p is None else top_p,
+            stream=stream,
+            prefixes=prefixes,
+            stop_sequences=self.stop_sequences if stop_sequences is None else stop_sequences,
+            adapter=adapter,
+            seed=self.seed if seed is None else seed,
+        )
+        if self._stopped:
+            raise RuntimeError("GenerationEngine has been stopped")
+        if self.response_cache is not None and cacheable(request.temperature, request.seed):
+            if request.temperature <= 0:
+                sampling = {"temperature": 0.0}
+            else:
+                sampling = {"temperature": request.temperature, "top_p": request.top_p, "seed": request.seed}
+            key = self.response_cache.key(
+                prompt,
+                self.model_id,
+                adapter=self.adapters.cache_id(adapter) if self.adapters is not None else adapter,
+                max_new_tokens=request.max_new_tokens,
+                stop_sequences=request.stop_sequences,
+                max_length=self.max_length,
+                **sampling
+            )
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                request.text = cached
+                request.stopped = True
+                self._complete(request)
+                return request
+            request.cache_key = key
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("GenerationEngine has been stopped")
+            self._waiting.append(request)
+            self._cond.notify()
+        return request
+
+    def load(self):
+        """
+        Number of queued and running requests, not counting cancelled ones.
+        """
+        with self._cond:
+            waiting = sum(not r.cancelled for r in self._waiting)
+            return waiting, sum(not r.cancelled for r in self._running)
+
+    def generate(self, prompts, **kwargs):
+        """
+        Blocking convenience wrapper: submits every prompt and returns the
+        generated texts in input order.
+        """
+        futures = [self.submit(p, **kwargs) for p in prompts]
+        return [f.result() for f in futures]
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._waiting and not self._running and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+            try:
+                with torch.inference_mode():
+                    self._admit()
+                    if self._running:
+                        self._step()
+            except Exception as e:
+                self._fail_running(e)
+
+        self._fail_running(RuntimeError("GenerationEngine stopped"))
+        with self._cond:
+            while self._waiting:
+                self._fail(self._waiting.popleft(), RuntimeError("GenerationEngine stopped"))
+
+    def _admit(self):
+        while len(self._running) < self.max_batch_size:
+            with self._cond:
+                if not self._waiting:
+                    return
+                request = self._waiting[0]
+                if request.input_ids is None:
+                    request.input_ids = self.tokenizer(
+                        request.prompt,
+                        truncation=True,
+                        max_length=self.max_length
+                    )["input_ids"]
+                if self._running and not self._fits(request):
+                    return
+                self._waiting.popleft()
+            if not request.future.set_running_or_notify_cancel():
+                self._fail(request, None)
+                continue
+            request.admitted_at = time.perf_counter()
+            try:
+                if self.adapters is not None:
+                    in_use = {r.adapter for r in self._running}
+                    request.adapter = self.adapters.prepare(request.adapter, in_use)
+                self._prefill(request)
+            except Exception as e:
+                self._fail(request, e)
+
+    def _fits(self, request):
+        """
+        Whether `request` can join the running batch without the padded
+        worst-case KV size (rows * longest prompt-plus-generation) exceeding
+        max_batch_tokens.
+        """
+        if self.max_batch_tokens is None:
+            return True
+        rows = self._running + [request]
+        width = max(len(r.input_ids) + r.max_new_tokens for r in rows)
+        return len(rows) * width <= self.max_batch_tokens
+
+    def _prefill(self, request):
+        input_ids = torch.tensor([request.input_ids], device=self.model.device)
+
+        model_kwargs = self._model_kwargs([request])
+        if self.prefix_cache is not None:
+            boundaries = prefix_boundaries(self.tokenizer, request.prompt, request.input_ids, request.prefixes)
+            out = self.prefix_cache.prefill(
+                self.model, request.input_ids, boundaries,
+                namespace=request.adapter, **model_kwargs
+            )
+        else:
+            out = self.model(input_ids=input_ids, use_cache=True, **model_kwargs)
+        first = self._sample([request], out.logits[:, -1, :])
+        if self._append_tokens([request], first)[0]:
+            self._complete(request)
+            return
+
+        kv = cache_to_tensors(out.past_key_values)
+        mask = torch.ones((1, input_ids.shape[1]), dtype=torch.long, device=input_ids.device)
+        self._join_batch(request, kv, mask, first)
+
+    def _join_batch(self, request, kv, mask, next_token):
+        if not self._running:
+            self._running = [request]
+            self._kv, self._mask, self._next_tokens = kv, mask, next_token
+            return
+        length = max(self._mask.shape[1], mask.shape[1])
+        batch_kv, batch_mask = left_pad_kv(self._kv, self._mask, length)
+        kv, mask = left_pad_kv(kv, mask, length)
+        self._kv = [
+            (torch.cat([bk, k], dim=0), torch.cat([bv, v], dim=0))
+            for (bk, bv), (k, v) in zip(batch_kv, kv)
+        ]
+        self._mask = torch.cat([batch_mask, mask], dim=0)
+        self._next_tokens = torch.cat([self._next_tokens, next_token], dim=0)
+        self._running.append(request)
+
+    def _step(self):
+        position_ids = self._mask.sum(dim=1, keepdim=True)
+        self._mask = torch.cat([self._mask, self._mask.new_ones((self._mask.shape[0], 1))], dim=1)
+
+        out = self.model(
+            input_ids=self._next_tokens.unsqueeze(-1),
+            attention_mask=self._mask,
+            position_ids=position_ids,
+            past_key_values=tensors_to_cache(self._kv, self.model.config),
+            use_cache=True,
+            **self._model_kwargs(self._running)
+        )
+        self._kv = cache_to_tensors(out.past_key_values)
+        self._next_tokens = self._sample(self._running, out.logits[:, -1, :])
+
+        finished = self._append_tokens(self._running, self._next_tokens)
+        if any(finished):
+            for request, done in zip(self._running, finished):
+                if done:
+                    self._complete(request)
+            self._retain([i for i, done in enumerate(finished) if not done])
+
+    def _model_kwargs(self, requests):
+        """
+        Extra forward arguments for a batch of requests: with an adapter
+        registry, each row runs through its own LoRA adapter.
+        """
+        if self.adapters is None:
+            return {}
+        return {"adapter_names": [r.adapter for r in requests]}
+
+    def _sample(self, requests, logits):
+        temperature = torch.tensor([r.temperature for r in requests], device=logits.device)
+        top_p = torch.tensor([r.top_p for r in requests], device=logits.device)
+        for r in requests:
+            if r.seed is not None and r.generator is None:
+                r.generator = torch.Generator(device=logits.device).manual_seed(r.seed)
+        return sample_next_tokens(logits, temperature, top_p, [r.generator for r in requests])
+
+    def _append_tokens(self, requests, tokens):
+        now = time.perf_counter()
+        finished = []
+        for request, token in zip(requests, tokens.tolist()):
+            request.token_times.append(now)
+            if token in self.eos_token_ids:
+                finished.append(True)
+                continue
+            request.generated.append(token)
+            if request.stop_sequences or request.stream is not None:
+                request.text = self.tokenizer.decode(request.generated, skip_special_tokens=True).lstrip()
+                cut = find_stop(request.text, request.stop_sequences)
+                if cut is not None:
+                    request.text = request.text[:cut]
+                    request.stopped = True
+            if request.stream is not None and not request.stopped:
+                self._emit(request)
+            finished.append(request.stopped or request.cancelled or len(request.generated) >= request.max_new_tokens)
+        return finished
+
+    def _emit(self, request, final=False):
+        """
+        Pushes the newly decoded suffix of a streamed request. Text ending in
+        an incomplete multi-byte character, or in what may be the start of a
+        stop sequence, is held back until the next token.
+        """
+        text = request.text
+        if not final:
+            if text.endswith("\ufffd"):
+                return
+            text = text[:len(text) - stop_holdback(text, request.stop_sequences)]
+        if len(text) > request.emitted_chars:
+            request.stream.put(text[request.emitted_chars:])
+            request.emitted_chars = len(text)
+
+    def _retain(self, rows):
+        """
+        Drops finished rows from the running batch and trims left padding
+        that no remaining row needs.
+        """
+        self._running = [self._running[i] for i in rows]
+        if not rows:
+            self._kv = self._mask = self._next_tokens = None
+            return
+        index = torch.tensor(rows, device=self._mask.device)
+        self._mask = self._mask.index_select(0, index)
+        start = int((self._mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        self._mask = self._mask[:, start:]
+        self._kv = [
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self._kv
+        ]
+        self._next_tokens = self._next_tokens.index_select(0, index)
+
+    def _complete(self, request):
+        request.finished_at = time.perf_counter()
+        if request.stopped:
+            text = request.text
+        else:
+            text = request.text = self.tokenizer.decode(request.generated, skip_special_tokens=True).lstrip()
+        if request.stream is not None:
+            self._emit(request, final=True)
+        if request.cache_key is not None and not request.cancelled:
+            self.response_cache.put(request.cache_key, text.strip())
+        request.future.set_result(text.strip())
+        if request.stream is not None:
+            request.stream.put(_STREAM_END)
+
+    def _fail(self, request, error):
+        request.finished_at = time.perf_counter()
+        if not request.future.done():
+            request.future.set_exception(error)
+        if request.stream is not None:
+            request.stream.put(_STREAM_END)
+
+    def _fail_running(self, error):
+        for request in self._running:
+            self._fail(request, error)
+        self._retain([])
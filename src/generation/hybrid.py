@@ -0,0 +1,223 @@
+import argparse
+import json
+from concurrent.futures import Future
+from pathlib import Path
+import numpy as np
+from src.evaluation.bleu import compute_bleu
+from src.generation.checkpoint import example_key
+from src.generation.stopping import dialogue_stop_sequences
+from src.util.build_prompt import build_prompt, build_prompt_prefixes
+
+TRAIN_DATA_PATH = "data/summarized_splits/dialogue_pairs_train_summarized.jsonl"
+VAL_DATA_PATH = "data/summarized_splits/dialogue_pairs_val_summarized.jsonl"
+# LLM predictions for the val split, e.g. from
+# `python -m src.generation.inference --data <VAL_DATA_PATH> --output <this>`.
+VAL_PREDICTIONS_PATH = "results/predictions/finetuned_model/val_predictions.jsonl"
+# The responder serves retrieved lines above the threshold recommended
+# here; recalibrate with `python -m src.generation.hybrid` after changing
+# the model or data.
+OUTPUT_PATH = "results/calibration/hybrid_threshold.json"
+RETRIEVAL_MODEL = "all-MiniLM-L6-v2"
+
+
+def load_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def load_retriever(train_data, model_name=RETRIEVAL_MODEL, device=None):
+    """
+    Sentence-transformer model and embedding index over the training split,
+    as built by the embedding_sim baseline.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from src.evaluation.baselines.embedding_sim.predict import build_retrieval_corpus
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    model = SentenceTransformer(model_name, device=device)
+    corpus_embeddings, responses = build_retrieval_corpus(train_data, model, device)
+    return model, corpus_embeddings, responses, device
+
+def calibrated_threshold(path=OUTPUT_PATH):
+    """
+    Similarity threshold recommended by the calibration report at `path`, or
+    None if there is no report or no threshold kept quality.
+    """
+    if path is None or not Path(path).exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        recommended = json.load(f)["recommended"]
+    return recommended["threshold"] if recommended else None
+
+def retrieve(retriever, examples):
+    from src.evaluation.baselines.embedding_sim.predict import retrieve_with_scores
+
+    model, corpus_embeddings, responses, device = retriever
+    return retrieve_with_scores(examples, model, corpus_embeddings, responses, device)
+
+
+class HybridResponder:
+    """
+    Answers with the nearest training example's response when its
+    similarity to the current turn reaches `threshold`, and only runs the
+    LLM (through a GenerationEngine) otherwise. The retrieval baseline keeps
+    the character's voice best at a fraction of the LLM's cost; the threshold
+    from `calibrate` decides how much quality to trade for skipped calls.
+
+    By default the threshold is the one recommended in `calibration_path`.
+    Without a recommendation nothing is retrieved and every turn goes to the
+    LLM.
+    """
+    def __init__(self, engine, retriever, threshold=None, calibration_path=OUTPUT_PATH):
+        self.engine = engine
+        self.retriever = retriever
+        self.threshold = calibrated_threshold(calibration_path) if threshold is None else threshold
+        self.retrieved = 0
+        self.generated = 0
+
+    def submit_batch(self, examples, **options):
+        """
+        Returns a Future per example. Retrieved lines resolve immediately;
+        the rest are queued on the engine together.
+        """
+        futures = []
+        if self.threshold is None:
+            matches = [(None, None)] * len(examples)
+        else:
+            matches = retrieve(self.retriever, examples)
+        for ex, (response, similarity) in zip(examples, matches):
+            if similarity is not None and similarity >= self.threshold:
+                self.retrieved += 1
+                future = Future()
+                future.set_result(response)
+            else:
+                self.generated += 1
+                future = self.engine.submit(
+                    build_prompt(ex),
+                    prefixes=build_prompt_prefixes(ex),
+                    stop_sequences=dialogue_stop_sequences(ex),
+                    **options
+                )
+            futures.append(future)
+        return futures
+
+    def respond(self, example, **options):
+        return self.submit_batch([example], **options)[0].result()
+
+    def stats(self):
+        total = self.retrieved + self.generated
+        return {
+            "threshold": self.threshold,
+            "retrieved": self.retrieved,
+            "generated": self.generated,
+            "llm_calls_avoided": self.retrieved / total if total else 0.0,
+        }
+
+
+def quality_scores(predictions, references, bertscore=False):
+    """
+    Per-example quality metrics against the gold responses.
+    """
+    scores = {"bleu": np.array(compute_bleu(predictions, references))}
+    if bertscore:
+        from bert_score import score
+
+        _, _, f1 = score(predictions, references, lang="en", verbose=False)
+        scores["bertscore_f1"] = f1.numpy()
+    return scores
+
+def sweep_thresholds(similarities, retrieved_scores, generated_scores, thresholds):
+    """
+    Quality of the hybrid responder at each threshold, given per-example
+    retrieval similarities and metric scores for the retrieved and generated
+    lines.
+    """
+    similarities = np.asarray(similarities)
+    sweep = []
+    for threshold in thresholds:
+        use_retrieved = similarities >= threshold
+        row = {"threshold": float(threshold), "llm_calls_avoided": float(use_retrieved.mean())}
+        for metric in generated_scores:
+            mixed = np.where(use_retrieved, retrieved_scores[metric], generated_scores[metric])
+            row[metric] = float(mixed.mean())
+        sweep.append(row)
+    return sweep
+
+def pick_threshold(sweep, llm_only, metric="bleu", tolerance=0.0):
+    """
+    Lowest threshold (most LLM calls avoided) whose quality stays within
+    `tolerance` of running the LLM on every turn.
+    """
+    passing = [row for row in sweep if row[metric] >= llm_only[metric] - tolerance]
+    return min(passing, key=lambda row: row["threshold"]) if passing else None
+
+def calibrate(train_data, val_data, val_predictions, thresholds=None, bertscore=False,
+              tolerance=0.0, retriever=None):
+    """
+    Sweeps similarity thresholds on the val split, comparing the hybrid
+    responder's quality with the LLM-only predictions in `val_predictions`.
+    """
+    by_key = {p["example_key"]: p["predicted_response"] for p in val_predictions}
+    val_data = [ex for ex in val_data if example_key(ex) in by_key]
+    generated = [by_key[example_key(ex)] for ex in val_data]
+    references = [ex["response"] for ex in val_data]
+
+    retriever = retriever or load_retriever(train_data)
+    retrieved, similarities = zip(*retrieve(retriever, val_data))
+    retrieved_scores = quality_scores(list(retrieved), references, bertscore)
+    generated_scores = quality_scores(generated, references, bertscore)
+
+    if thresholds is None:
+        thresholds = np.round(np.arange(0.5, 1.001, 0.02), 2)
+    sweep = sweep_thresholds(similarities, retrieved_scores, generated_scores, thresholds)
+    llm_only = {m: float(s.mean()) for m, s in generated_scores.items()}
+    return {
+        "examples": len(val_data),
+        "llm_only": llm_only,
+        "retrieval_only": {m: float(s.mean()) for m, s in retrieved_scores.items()},
+        "similarity_percentiles": {
+            str(q): float(np.percentile(similarities, q)) for q in (10, 25, 50, 75, 90)
+        },
+        "recommended": pick_threshold(sweep, llm_only, tolerance=tolerance),
+        "sweep": sweep,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the hybrid responder's similarity threshold.")
+    parser.add_argument("--train", default=TRAIN_DATA_PATH)
+    parser.add_argument("--val", default=VAL_DATA_PATH)
+    parser.add_argument("--llm-predictions", default=VAL_PREDICTIONS_PATH)
+    parser.add_argument("--bertscore", action="store_true", help="Also report BERTScore F1.")
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="BLEU the recommended threshold may lose against the LLM alone.")
+    parser.add_argument("--output", default=OUTPUT_PATH)
+    args = parser.parse_args()
+
+    report = calibrate(
+        load_jsonl(args.train),
+        load_jsonl(args.val),
+        load_jsonl(args.llm_predictions),
+        bertscore=args.bertscore,
+        tolerance=args.tolerance
+    )
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+
+    metrics = list(report["llm_only"])
+    print("threshold  avoided  " + "  ".join(metrics))
+    for row in report["sweep"]:
+        print(f"{row['threshold']:9.2f}  {row['llm_calls_avoided']:7.1%}  " +
+              "  ".join(f"{row[m]:.4f}" for m in metrics))
+    print(f"LLM only: {report['llm_only']}, retrieval only: {report['retrieval_only']}")
+    if report["recommended"]:
+        print(f"Recommended threshold: {report['recommended']['threshold']:.2f} "
+              f"({report['recommended']['llm_calls_avoided']:.1%} of LLM calls avoided)")
+    else:
+        print("No threshold keeps quality within tolerance; leave the short-circuit off.")
+    print(f"Saved calibration to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,88 +1,244 @@
+import argparse
 import json
-from pathlib import Path
 from transformers import AutoTokenizer, AutoModelForCausalLM
-from torch.amp import autocast
 import torch
 from tqdm import tqdm
-from src.util.build_prompt import build_prompt
+from src.util.build_prompt import build_prompt, build_prompt_context, build_prompt_prefixes
+from src.generation.engine import GenerationEngine
+from src.generation.prefix_cache import PrefixCache
+from src.generation.response_cache import ResponseCache, weights_fingerprint
+from src.generation.batching import bucket_batches
+from src.generation.stopping import dialogue_stop_sequences
+from src.generation.speculative import SpeculativeDecoder
+from src.generation.cpu_backend import load_cpu_model
+from src.generation.adapters import AdapterRegistry, adapter_name
+from src.generation.checkpoint import PredictionLog, example_key, merge_predictions, shard_path
+from src.generation.parallel import launch_workers
 
 BASE_MODEL_PATH = "models/lora_adapters/arthur_morgan" # TODO update to finetuned
 TEST_DATA_PATH = "data/summarized_splits/dialogue_pairs_test_summarized.jsonl"
 OUTPUT_PATH = "results/predictions/finetuned_model/predictions.jsonl"
 BATCH_SIZE = 8
+MAX_BATCH_TOKENS = 8192
+PREFIX_CACHE_ENTRIES = 16
+# Set to a small model sharing the tokenizer (e.g. "models/base/qwen2.5-0.5b")
+# to decode with speculative decoding instead of the batched engine.
+DRAFT_MODEL_PATH = None
+# CPU weight quantization: None (fp32), "int8" or "int4". Check quality with
+# `python -m src.generation.cpu_backend` before switching.
+CPU_QUANTIZATION = None
+# Set ADAPTERS_DIR to serve every character adapter from one resident copy of
+# BASE_WEIGHTS_PATH; each example then uses its response speaker's adapter.
+BASE_WEIGHTS_PATH = "models/base/qwen2.5-3b"
+ADAPTERS_DIR = None
+MAX_LOADED_ADAPTERS = 4
+# Sampling seed of every request, so that responses are reproducible and can
+# be cached. None samples freshly each time (and disables response caching).
+SAMPLING_SEED = 0
+# Greedy or seeded responses are cached here across runs and processes.
+# None disables the cache.
+RESPONSE_CACHE_PATH = "results/cache/responses.sqlite"
 
 def load_jsonl(path):
     with open(path, "r") as f:
         for line in f:
             yield json.loads(line)
 
-def batch_iterator(iterable, batch_size):
-    batch = []
-    for item in iterable:
-        batch.append(item)
-        if len(batch) == batch_size:
-            yield batch
-            batch = []
-    if batch:
-        yield batch
-
-def main():
+def load_model(model_path=BASE_MODEL_PATH, quantization=CPU_QUANTIZATION):
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    Path(OUTPUT_PATH).parent.mkdir(parents=True, exist_ok=True)
+    if device == "cpu":
+        return load_cpu_model(model_path, quantization=quantization)
 
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_PATH)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
     tokenizer.pad_token = tokenizer.eos_token
     tokenizer.padding_side = "left"
 
     model = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL_PATH,
+        model_path,
         dtype=torch.bfloat16 if device == "cuda" else torch.float32,
         device_map="auto",
     )
+    model.eval()
+
+    return tokenizer, model
+
+def load_engine(model_path=BASE_MODEL_PATH, max_batch_size=BATCH_SIZE, max_batch_tokens=MAX_BATCH_TOKENS,
+                adapters_dir=None):
+    """
+    Loads the model once and returns a started GenerationEngine that keeps it
+    resident for submit()/generate() calls. Shared prompt prefixes are served
+    from an LRU prefix KV cache.
+
+    With `adapters_dir`, `model_path` is the base model and every adapter
+    saved under `adapters_dir` is served from it; requests choose one with
+    submit(..., adapter=name) and can share a batch across characters.
+    """
+    adapters = None
+    # LoRA layers wrap plain Linear modules, so a shared base stays unquantized.
+    quantization = CPU_QUANTIZATION if adapters_dir is None and not torch.cuda.is_available() else None
+    tokenizer, model = load_model(model_path, quantization=quantization)
+    if adapters_dir is not None:
+        adapters = AdapterRegistry.from_directory(model, adapters_dir, max_loaded=MAX_LOADED_ADAPTERS)
+        adapters.prepare(next(iter(adapters.paths)))
+        model = adapters.model
+    return GenerationEngine(
+        model,
+        tokenizer,
+        max_batch_size=max_batch_size,
+        max_batch_tokens=max_batch_tokens,
+        max_length=1024,
+        max_new_tokens=120,
+        temperature=0.7,
+        top_p=0.9,
+        prefix_cache=PrefixCache(max_entries=PREFIX_CACHE_ENTRIES),
+        adapters=adapters,
+        response_cache=ResponseCache(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH else None,
+        # The fingerprint keeps cached responses of weights retrained in place
+        # from being served for the new ones.
+        model_id=f"{model_path}@{weights_fingerprint(model_path)}:{quantization or 'unquantized'}",
+        seed=SAMPLING_SEED
+    ).start()
+
+def stream_response(engine, example, use_context=False):
+    """
+    Streams the reply for one example, printing text as it arrives, and stops
+    once the model starts another turn or section. Returns the full reply and
+    its latency stats (time-to-first-token, inter-token latency).
+    """
+    if use_context:
+        prompt, prefixes = build_prompt_context(example), ()
+    else:
+        prompt, prefixes = build_prompt(example), build_prompt_prefixes(example)
+    stream = engine.stream(prompt, prefixes=prefixes, stop_sequences=dialogue_stop_sequences(example))
+    for piece in stream:
+        print(piece, end="", flush=True)
+    print()
+    return stream.text(), stream.stats()
+
+def predict_with_engine(test_data):
+    if ADAPTERS_DIR:
+        engine = load_engine(BASE_WEIGHTS_PATH, adapters_dir=ADAPTERS_DIR)
+    else:
+        engine = load_engine()
+
+    # Everything is queued up front, grouped by prompt length so rows that
+    # share the running batch need little padding; the engine refills decode
+    # slots as soon as individual rows finish. Results come back in file order.
+    prompts = [build_prompt(ex) for ex in test_data]
+    lengths = [len(ids) for ids in engine.tokenizer(prompts, truncation=True, max_length=1024)["input_ids"]]
+    futures = [None] * len(test_data)
+    for batch in bucket_batches(lengths, engine.max_batch_tokens, engine.max_batch_size, reserve_tokens=120):
+        for i in batch:
+            futures[i] = engine.submit(
+                prompts[i],
+                prefixes=build_prompt_prefixes(test_data[i]),
+                stop_sequences=dialogue_stop_sequences(test_data[i]),
+                adapter=adapter_name(test_data[i]["response_speaker"]) if ADAPTERS_DIR else None
+            )
+
+    for future in futures:
+        yield future.result()
+
+    engine.stop()
+    print(f"Prefix cache: {engine.prefix_cache.stats()}")
+    if engine.response_cache is not None:
+        print(f"Response cache: {engine.response_cache.stats()}")
+    if engine.adapters is not None:
+        print(f"Adapters: {engine.adapters.stats()}")
+
+def predict_speculative(test_data, draft_model_path=DRAFT_MODEL_PATH):
+    tokenizer, model = load_model()
+    _, draft = load_model(draft_model_path)
+    decoder = SpeculativeDecoder(
+        model,
+        draft,
+        tokenizer,
+        max_length=1024,
+        max_new_tokens=120,
+        temperature=0.7,
+        top_p=0.9
+    )
+
+    for ex in test_data:
+        yield decoder.generate(build_prompt(ex), stop_sequences=dialogue_stop_sequences(ex))
 
-    test_data = list(load_jsonl(TEST_DATA_PATH))
-    print(f"Test data loaded: {len(test_data)} examples")
-
-    with open(OUTPUT_PATH, "w", encoding="utf-8") as outfile:
-        for batch in tqdm(batch_iterator(test_data, BATCH_SIZE),
-                          total=(len(test_data) + BATCH_SIZE - 1) // BATCH_SIZE,
-                          desc="Generating..."):
-            prompts = [build_prompt(ex) for ex in batch]
-            inputs = tokenizer(
-                prompts,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=1024
-            ).to(device)
-
-            with autocast(device_type="cuda", dtype=torch.bfloat16):
-                output_ids = model.generate(
-                    **inputs,
-                    max_new_tokens=120,
-                    temperature=0.7,
-                    top_p=0.9,
-                    pad_token_id=tokenizer.pad_token_id
-                )
-            
-            for i, (ex, prompt) in enumerate(zip(batch, prompts)):
-                decoded = tokenizer.decode(output_ids[i], skip_special_tokens=True)
-                prediction = decoded[len(prompt):].strip()
-
-                outfile.write(json.dumps({
-                    "mission": ex.get("mission", ""),
-                    "context": ex.get("context", ""),
-                    "speaker": ex.get("speaker", ""),
-                    "utterance": ex.get("utterance", ""),
-                    "response_speaker": ex.get("response_speaker", ""),
-                    "gold_response": ex.get("response", ""),
-                    "gold_response_action": ex.get("gold_response_action", "none"),
-                    "predicted_response": prediction
-                }) + "\n")
-
-    print(f"Wrote baseline LLM predictions to {OUTPUT_PATH}")
+    print(f"Draft acceptance rate: {decoder.acceptance_rate():.3f}")
+
+def prediction_record(ex, prediction):
+    return {
+        "example_key": example_key(ex),
+        "mission": ex.get("mission", ""),
+        "context": ex.get("context", ""),
+        "speaker": ex.get("speaker", ""),
+        "utterance": ex.get("utterance", ""),
+        "response_speaker": ex.get("response_speaker", ""),
+        "gold_response": ex.get("response", ""),
+        "gold_response_action": ex.get("gold_response_action", "none"),
+        "predicted_response": prediction
+    }
+
+def run_predictions(examples, log_path, flush_every=BATCH_SIZE):
+    """
+    Predicts every example not yet recorded in the log at `log_path`,
+    appending finished predictions to it every `flush_every` examples, so an
+    interrupted run picks up where it stopped.
+    """
+    with PredictionLog(log_path) as log:
+        pending = [ex for ex in examples if example_key(ex) not in log]
+        print(f"{len(examples) - len(pending)} of {len(examples)} examples already done")
+        if not pending:
+            return
+
+        if DRAFT_MODEL_PATH:
+            predictions = predict_speculative(pending)
+        else:
+            predictions = predict_with_engine(pending)
+
+        buffer = []
+        for ex, prediction in tqdm(zip(pending, predictions), total=len(pending), desc="Generating..."):
+            buffer.append(prediction_record(ex, prediction))
+            if len(buffer) >= flush_every:
+                log.append(buffer)
+                buffer = []
+        log.append(buffer)
+
+        # Drain the generator so its closing report runs.
+        for _ in predictions:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate NPC responses for a dialogue split.")
+    parser.add_argument("--data", default=TEST_DATA_PATH, help="Input JSONL of dialogue examples.")
+    parser.add_argument("--output", default=OUTPUT_PATH, help="Predictions JSONL, in input order.")
+    parser.add_argument("--shard-index", type=int, default=0)
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--merge", action="store_true",
+                        help="Only merge existing shard logs into --output.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Run this many shard processes, each pinned to its own cores, then merge.")
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.workers:
+        launch_workers(args.workers, args.data, args.output, args.threads_per_worker)
+        args.num_shards, args.merge = args.workers, True
+
+    data = list(load_jsonl(args.data))
+    print(f"Data loaded: {len(data)} examples")
+    logs = [shard_path(args.output, i, args.num_shards) for i in range(args.num_shards)]
+
+    if not args.merge:
+        shard = data[args.shard_index::args.num_shards]
+        run_predictions(shard, logs[args.shard_index])
+        if args.num_shards > 1:
+            print(f"Shard {args.shard_index} done; run with --merge once every shard has finished")
+            return
+
+    missing = merge_predictions(logs, data, args.output)
+    if missing:
+        print(f"Warning: {missing} examples have no prediction yet")
+    print(f"Wrote baseline LLM predictions to {args.output}")
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+
+WORKER_MODULE = "src.generation.inference"
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def core_groups(num_workers, threads_per_worker=None):
+    """
+    Splits the usable cores into disjoint groups, one per worker. Without
+    `threads_per_worker` every core is handed out as evenly as possible.
+    """
+    cores = available_cores()
+    if threads_per_worker is None:
+        threads_per_worker = max(len(cores) // num_workers, 1)
+    groups = []
+    for i in range(num_workers):
+        group = cores[i * threads_per_worker:(i + 1) * threads_per_worker]
+        # More workers than cores: let the extra ones share the first cores.
+        groups.append(group or cores[:threads_per_worker])
+    return groups
+
+def launch_workers(num_workers, data_path, output_path, threads_per_worker=None, extra_args=()):
+    """
+    Runs one inference process per shard of `data_path`, each pinned to its
+    own group of cores with matching OpenMP/MKL thread counts, and waits for
+    all of them. Every worker loads its own model copy; safetensors weights
+    are memory-mapped, so the checkpoint files are read once into the shared
+    page cache. Raises if any worker fails; finished shards are kept, so a
+    rerun only redoes what is missing.
+    """
+    processes = []
+    for i, cores in enumerate(core_groups(num_workers, threads_per_worker)):
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+        command = [
+            sys.executable, "-m", WORKER_MODULE,
+            "--data", data_path,
+            "--output", output_path,
+            "--shard-index", str(i),
+            "--num-shards", str(num_workers),
+            *extra_args
+        ]
+        pin = (lambda cores=cores: os.sched_setaffinity(0, cores)) if hasattr(os, "sched_setaffinity") else None
+        processes.append(subprocess.Popen(command, env=env, preexec_fn=pin))
+        print(f"Worker {i}: pid {processes[-1].pid}, cores {cores[0]}-{cores[-1]}")
+
+    failed = [i for i, p in enumerate(processes) if p.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Inference workers {failed} failed; rerun to resume their shards")
@@ -0,0 +1,174 @@
+from collections import OrderedDict
+import torch
+from src.generation.cache_utils import cache_to_tensors, tensors_to_cache, kv_nbytes
+
+
+class PrefixCache:
+    """
+    LRU store of attention KV states for prompt prefixes, keyed by their token
+    ids. Prompts that start with a cached prefix only need their suffix
+    prefilled. `namespace` separates entries whose KV states differ for the
+    same tokens, e.g. different LoRA adapters on one base model.
+    """
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lengths = {}
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, input_ids, namespace=None):
+        """
+        Returns (length, kv) for the longest cached prefix of `input_ids` that
+        still leaves at least one token to run, or (0, None).
+        """
+        for length in sorted(self._lengths, reverse=True):
+            if length >= len(input_ids):
+                continue
+            key = (namespace, tuple(input_ids[:length]))
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.reused_tokens += length
+                return length, self._entries[key]
+        self.misses += 1
+        return 0, None
+
+    def insert(self, prefix_ids, kv, namespace=None):
+        key = (namespace, tuple(prefix_ids))
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = kv
+        length = len(prefix_ids)
+        self._lengths[length] = self._lengths.get(length, 0) + 1
+        while len(self._entries) > self.max_entries:
+            (_, old), _ = self._entries.popitem(last=False)
+            self._lengths[len(old)] -= 1
+            if not self._lengths[len(old)]:
+                del self._lengths[len(old)]
+
+    def clear(self):
+        self._entries.clear()
+        self._lengths.clear()
+
+    def prefill(self, model, input_ids, boundaries=(), namespace=None, **model_kwargs):
+        """
+        Runs `input_ids` (a list of token ids) through the model, starting from
+        the longest cached prefix and caching the KV state at every boundary
+        length passed through. Returns the model output for the final chunk;
+        its past_key_values cover the whole prompt.
+        """
+        length, kv = self.lookup(input_ids, namespace)
+        for boundary in sorted(set(boundaries)):
+            if boundary <= length or boundary >= len(input_ids):
+                continue
+            out = _forward(model, input_ids[length:boundary], kv, **model_kwargs)
+            kv = cache_to_tensors(out.past_key_values)
+            self.insert(input_ids[:boundary], kv, namespace)
+            length = boundary
+        return _forward(model, input_ids[length:], kv, **model_kwargs)
+
+    def get_or_compute(self, model, prefix_ids, namespace=None):
+        """
+        Returns the KV state for exactly `prefix_ids`, computing and caching
+        it on a miss.
+        """
+        key = (namespace, tuple(prefix_ids))
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.reused_tokens += len(prefix_ids)
+            return self._entries[key]
+        self.misses += 1
+        kv = cache_to_tensors(_forward(model, list(prefix_ids), None).past_key_values)
+        self.insert(prefix_ids, kv, namespace)
+        return kv
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens,
+            "bytes": sum(kv_nbytes(kv) for kv in self._entries.values()),
+        }
+
+
+def _forward(model, input_ids, kv, **model_kwargs):
+    ids = torch.tensor([input_ids], device=model.device)
+    past = tensors_to_cache(kv, model.config) if kv is not None else None
+    return model(input_ids=ids, past_key_values=past, use_cache=True, **model_kwargs)
+
+def prefix_boundaries(tokenizer, prompt, input_ids, prefixes):
+    """
+    Token lengths of the given string prefixes of `prompt`. A prefix is only
+    kept when it tokenizes to an exact token prefix of `input_ids`, otherwise
+    reusing its KV state would change the prompt.
+    """
+    boundaries = []
+    for prefix in prefixes:
+        if not prompt.startswith(prefix):
+            continue
+        prefix_ids = tokenizer(prefix)["input_ids"]
+        if prefix_ids and list(input_ids[:len(prefix_ids)]) == prefix_ids:
+            boundaries.append(len(prefix_ids))
+    return boundaries
+
+def generate_with_prefix(model, tokenizer, prefix, suffixes, prefix_cache, **generate_kwargs):
+    """
+    Batched model.generate for prompts `prefix + suffix`. The shared prefix is
+    prefilled once (or taken from `prefix_cache`) and expanded over the batch;
+    suffixes are padded between the prefix and the suffix tokens so the
+    prefix occupies the same positions in every row. Returns the generated
+    token ids per row.
+    """
+    prefix_ids = tokenizer(prefix)["input_ids"]
+    suffix_ids = [tokenizer(s, add_special_tokens=False)["input_ids"] for s in suffixes]
+    kv = prefix_cache.get_or_compute(model, prefix_ids)
+
+    pad_id = tokenizer.pad_token_id
+    width = max(len(s) for s in suffix_ids)
+    input_ids = torch.tensor(
+        [prefix_ids + [pad_id] * (width - len(s)) + s for s in suffix_ids],
+        device=model.device
+    )
+    attention_mask = torch.tensor(
+        [[1] * len(prefix_ids) + [0] * (width - len(s)) + [1] * len(s) for s in suffix_ids],
+        device=model.device
+    )
+    batch = len(suffixes)
+    past = tensors_to_cache(
+        [(k.expand(batch, -1, -1, -1).contiguous(), v.expand(batch, -1, -1, -1).contiguous()) for k, v in kv],
+        model.config
+    )
+
+    outputs = model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        past_key_values=past,
+        pad_token_id=pad_id,
+        **generate_kwargs
+    )
+    return [row.tolist() for row in outputs[:, input_ids.shape[1]:]]
+
+def split_prefix(tokenizer, prompt, prefix):
+    """
+    Returns the suffix of `prompt` after `prefix` when the prefix can be
+    reused at token level, otherwise None.
+    """
+    if not prompt.startswith(prefix):
+        return None
+    prompt_ids = tokenizer(prompt)["input_ids"]
+    boundaries = prefix_boundaries(tokenizer, prompt, prompt_ids, [prefix])
+    if not boundaries:
+        return None
+    suffix = prompt[len(prefix):]
+    prefix_len = boundaries[0]
+    if tokenizer(suffix, add_special_tokens=False)["input_ids"] != prompt_ids[prefix_len:]:
+        return None
+    return suffix
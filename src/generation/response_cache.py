@@ -0,0 +1,124 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+
+def normalize_prompt(prompt):
+    """
+    Canonical form of a prompt for cache keys. Only differences that cannot
+    matter to the model are folded (Unicode normalization, line endings), so
+    equal keys always mean equal token ids.
+    """
+    return unicodedata.normalize("NFC", prompt).replace("\r\n", "\n")
+
+def weights_fingerprint(path):
+    """
+    Short hash identifying the weights saved at `path`: its config files and
+    the size and modification time of each weight file, plus the base model
+    of a LoRA adapter. Retraining into the same directory changes it. None
+    when `path` is not a local directory (e.g. a hub model id).
+    """
+    path = Path(path)
+    if not path.is_dir():
+        return None
+    digest = hashlib.sha256()
+    for name in ("config.json", "adapter_config.json"):
+        if (path / name).exists():
+            digest.update((path / name).read_bytes())
+    for weights in sorted([*path.glob("*.safetensors"), *path.glob("*.bin")]):
+        stat = weights.stat()
+        digest.update(f"{weights.name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    if (path / "adapter_config.json").exists():
+        base = json.loads((path / "adapter_config.json").read_text()).get("base_model_name_or_path")
+        digest.update(str(base and weights_fingerprint(base)).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+def cacheable(temperature, seed=None):
+    """
+    Only deterministic decoding may be answered from the cache.
+    """
+    return temperature <= 0 or seed is not None
+
+
+class ResponseCache:
+    """
+    Cache of generated responses keyed by prompt, model/adapter and decoding
+    parameters. Lookups hit an in-memory LRU of `max_entries` first and then,
+    when `path` is set, an SQLite file that persists across runs and is
+    shared by every process pointed at it. Only use it for greedy or seeded
+    decoding (see `cacheable`); sampled outputs are not reproducible.
+    """
+    def __init__(self, path=None, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)")
+            self._db.commit()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(prompt, model_id, adapter=None, **params):
+        """
+        `params` are the decoding parameters that affect the output, e.g.
+        max_new_tokens, temperature, top_p, stop_sequences and seed.
+        """
+        payload = json.dumps({
+            "prompt": normalize_prompt(prompt),
+            "model": model_id,
+            "adapter": adapter,
+            "params": {k: list(v) if isinstance(v, tuple) else v for k, v in params.items()},
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            if self._db is not None:
+                row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._remember(key, row[0])
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        with self._lock:
+            self._remember(key, response)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?)", (key, response))
+                self._db.commit()
+
+    def _remember(self, key, response):
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,223 @@
+import threading
+import time
+from concurrent.futures import Future
+from src.generation.stopping import dialogue_stop_sequences
+from src.util.build_prompt import build_prompt, build_prompt_prefixes
+
+# A line that arrives later than this is worse than a canned one.
+DEADLINE_SECONDS = 0.8
+# Weight of the newest measurement in the moving averages.
+EMA_WEIGHT = 0.2
+
+
+def retrieval_fallback(train_data, model_name="all-MiniLM-L6-v2", device=None):
+    """
+    Returns a function mapping an example to the response of its most similar
+    training example, using the embedding_sim baseline's index.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from src.evaluation.baselines.embedding_sim.predict import build_retrieval_corpus, retrieve_response
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    model = SentenceTransformer(model_name, device=device)
+    corpus_embeddings, responses = build_retrieval_corpus(train_data, model, device)
+    return lambda example: retrieve_response(example, model, corpus_embeddings, responses, device)
+
+
+class ScheduledTurn:
+    """
+    Handle for one scheduled NPC line. `result()` blocks until the line is
+    ready; `source` then says where it came from: "llm", "fallback" (the LLM
+    was not expected to make the deadline), "deadline_fallback" (decoding was
+    cancelled at the deadline) or "partial" (cancelled at the deadline with
+    no fallback; the text generated so far is returned).
+    """
+    def __init__(self, example, deadline):
+        self.example = example
+        self.deadline = deadline
+        self.submitted_at = time.perf_counter()
+        self.future = Future()
+        self.source = None
+        self.estimate = None
+        self.latency = None
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future.done()
+
+
+class DeadlineScheduler:
+    """
+    Sits in front of a GenerationEngine and gives every request a deadline.
+    Completion time is estimated from the engine's queue depth and the
+    prefill and decode rates measured on earlier requests. Requests that
+    cannot make their deadline go straight to `fallback` (e.g.
+    retrieval_fallback); requests still decoding when it passes are
+    cancelled and answered by the fallback, or with their partial text when
+    there is none.
+
+    Measurements only come from requests the LLM answers, so a turn sent to
+    the fallback while the engine is idle also goes to the LLM as a probe
+    (its line is discarded). Without it, one slow measurement that pushed
+    the estimate over the deadline would send every later turn to the
+    fallback for good.
+    """
+    def __init__(self, engine, fallback=None, deadline=DEADLINE_SECONDS):
+        self.engine = engine
+        self.fallback = fallback
+        self.deadline = deadline
+        self._lock = threading.Lock()
+
+        # Moving averages, None until the first request completes.
+        self.step_seconds = None
+        self.prefill_seconds_per_token = None
+        self.response_tokens = None
+        self._probing = False
+
+        self.counts = {
+            "requests": 0,
+            "llm": 0,
+            "on_time": 0,
+            "fallback": 0,
+            "deadline_fallback": 0,
+            "partial": 0,
+            "probes": 0,
+        }
+        self.latencies = []
+
+    def estimate(self, prompt_tokens):
+        """
+        Expected seconds until a new request with `prompt_tokens` tokens would
+        finish, or None before anything has been measured. Requests queued
+        beyond the free decode slots wait about one response length per full
+        batch ahead of them.
+        """
+        if self.step_seconds is None:
+            return None
+        waiting, running = self.engine.load()
+        decode = self.response_tokens * self.step_seconds
+        batches_ahead = max(waiting + running + 1 - self.engine.max_batch_size, 0) / self.engine.max_batch_size
+        prefill = prompt_tokens * (self.prefill_seconds_per_token or 0.0)
+        return batches_ahead * decode + prefill + decode
+
+    def submit(self, example, deadline=None, **options):
+        """
+        Schedules the response for `example` and returns a ScheduledTurn.
+        `options` are passed on to the engine (see GenerationEngine.submit).
+        """
+        turn = ScheduledTurn(example, self.deadline if deadline is None else deadline)
+        with self._lock:
+            self.counts["requests"] += 1
+
+        prompt = build_prompt(example)
+        prompt_tokens = len(self.engine.tokenizer(prompt)["input_ids"])
+        turn.estimate = self.estimate(prompt_tokens)
+        options.setdefault("prefixes", build_prompt_prefixes(example))
+        options.setdefault("stop_sequences", dialogue_stop_sequences(example))
+        if self.fallback is not None and turn.estimate is not None and turn.estimate > turn.deadline:
+            self._resolve(turn, self.fallback(example), "fallback")
+            self._probe(prompt, options)
+            return turn
+
+        request = self.engine.submit_request(prompt, **options)
+
+        timer = threading.Timer(turn.deadline, self._on_deadline, (turn, request))
+        timer.daemon = True
+        timer.start()
+        request.future.add_done_callback(lambda _: self._on_done(turn, request, timer))
+        return turn
+
+    def _on_done(self, turn, request, timer):
+        # Runs on the engine thread, so it must not do slow work.
+        timer.cancel()
+        if request.future.cancelled() or request.future.exception() is not None:
+            return
+        self._learn(request)
+        if not request.cancelled:
+            self._resolve(turn, request.future.result(), "llm")
+
+    def _probe(self, prompt, options):
+        """
+        Runs one request just to measure the engine, if it is idle and no
+        other probe is running.
+        """
+        with self._lock:
+            if self._probing or self.engine.load() != (0, 0):
+                return
+            self._probing = True
+            self.counts["probes"] += 1
+        request = self.engine.submit_request(prompt, **options)
+        request.future.add_done_callback(lambda _: self._on_probe_done(request))
+
+    def _on_probe_done(self, request):
+        with self._lock:
+            self._probing = False
+        if not request.future.cancelled() and request.future.exception() is None:
+            self._learn(request)
+
+    def _on_deadline(self, turn, request):
+        if request.future.done() and not request.cancelled:
+            return
+        request.cancel()
+        if self.fallback is not None:
+            self._resolve(turn, self.fallback(turn.example), "deadline_fallback")
+        else:
+            # A queued request resolves to nothing; a running one to its text so far.
+            text = request.text if not request.future.cancelled() else ""
+            self._resolve(turn, text.strip(), "partial")
+
+    def _resolve(self, turn, text, source):
+        with self._lock:
+            if turn.future.done():
+                return
+            turn.source = source
+            turn.latency = time.perf_counter() - turn.submitted_at
+            self.counts[source] += 1
+            if source == "llm" and turn.latency <= turn.deadline:
+                self.counts["on_time"] += 1
+            self.latencies.append(turn.latency)
+        turn.future.set_result(text)
+
+    def _learn(self, request):
+        # Response-cache hits never reach the model and measure nothing.
+        if request.admitted_at is None:
+            return
+        stats = request.stats()
+        with self._lock:
+            if stats["mean_inter_token_latency"] is not None:
+                self.step_seconds = _ema(self.step_seconds, stats["mean_inter_token_latency"])
+            if request.admitted_at is not None and request.token_times and stats["prompt_tokens"]:
+                per_token = (request.token_times[0] - request.admitted_at) / stats["prompt_tokens"]
+                self.prefill_seconds_per_token = _ema(self.prefill_seconds_per_token, per_token)
+            if request.cancelled:
+                # Only a lower bound on the response length; averaging it in
+                # would let a turn cut short at the deadline shrink the
+                # estimate until every turn runs into the deadline.
+                self.response_tokens = max(self.response_tokens or 0, stats["generated_tokens"])
+            else:
+                self.response_tokens = _ema(self.response_tokens, stats["generated_tokens"])
+
+    def stats(self):
+        """
+        Deadline hit rate is the share of requests answered by the LLM within
+        their deadline; fallback rate counts both kinds of fallback.
+        """
+        with self._lock:
+            requests = self.counts["requests"]
+            latencies = sorted(self.latencies)
+            return {
+                **self.counts,
+                "deadline_hit_rate": self.counts["on_time"] / requests if requests else 0.0,
+                "fallback_rate": (self.counts["fallback"] + self.counts["deadline_fallback"]) / requests if requests else 0.0,
+                "p50_latency": latencies[len(latencies) // 2] if latencies else None,
+                "p95_latency": latencies[int(len(latencies) * 0.95)] if latencies else None,
+                "step_seconds": self.step_seconds,
+                "response_tokens": self.response_tokens,
+            }
+
+
+def _ema(average, value):
+    return value if average is None else (1 - EMA_WEIGHT) * average + EMA_WEIGHT * value
@@ -0,0 +1,158 @@
+from collections import deque
+import torch
+from src.generation.cache_utils import crop_cache, tensors_to_cache
+from src.generation.engine import sample_next_tokens
+from src.generation.stopping import dialogue_stop_sequences, find_stop
+from src.util.build_prompt import build_prompt_prefixes
+
+# Number of turns kept in the prompt, as in preprocess_dialogue.
+WINDOW_LEN = 10
+
+
+class DialogueSession:
+    """
+    One live conversation with a resident model. The prompt is the
+    build_prompt header (preamble, mission, memory and knowledge) followed by
+    the last `window_len` turns, so a session that has seen a single turn
+    prompts exactly like build_prompt.
+
+    The session keeps the token ids of its last prompt and their KV cache.
+    Each turn is tokenized once, and only tokens after the longest prefix
+    shared with the cached ids are run through the model: the new turn while
+    the window is filling, the turns still in the window once it slides. The
+    header's KV state can come from a shared PrefixCache, so sessions in the
+    same mission compute it once.
+    """
+    def __init__(self, model, tokenizer, mission, response_speaker, memory_summary="",
+                 knowledge_summary="", window_len=WINDOW_LEN, prefix_cache=None,
+                 max_new_tokens=120, temperature=0.7, top_p=0.9, stop_sequences=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.response_speaker = response_speaker
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        if stop_sequences is None:
+            stop_sequences = dialogue_stop_sequences({"response_speaker": response_speaker})
+        self.stop_sequences = stop_sequences
+
+        self.header = build_prompt_prefixes({
+            "mission": mission,
+            "memory_summary": memory_summary,
+            "knowledge_summary": knowledge_summary,
+        })[-1] + "Dialogue:\n"
+        self.header_ids = tokenizer(self.header)["input_ids"]
+        self.turns = deque(maxlen=window_len)
+        self.prefix_cache = prefix_cache
+
+        eos = model.generation_config.eos_token_id
+        eos = eos if isinstance(eos, (list, tuple)) else [eos]
+        self.eos_token_ids = {t for t in [*eos, tokenizer.eos_token_id] if t is not None}
+
+        self._ids = []
+        self._cache = None
+        self.processed_tokens = 0
+        self.reused_tokens = 0
+
+    @classmethod
+    def from_example(cls, model, tokenizer, example, **kwargs):
+        """
+        Starts a session in the same state as a dataset example: header from
+        its mission and summaries, and its utterance as the first turn.
+        """
+        kwargs.setdefault("stop_sequences", dialogue_stop_sequences(example))
+        session = cls(model, tokenizer, example["mission"], example["response_speaker"],
+                      example.get("memory_summary", ""), example.get("knowledge_summary", ""), **kwargs)
+        session.add_turn(example["speaker"], example["utterance"])
+        return session
+
+    def prompt(self):
+        lines = "".join(f"{speaker}: {text}\n" for speaker, text, _ in self.turns)
+        return self.header + lines + f"\n{self.response_speaker}:"
+
+    def add_turn(self, speaker, text):
+        """
+        Appends a turn to the window and prefills it right away, so the next
+        respond() only has to run the response cue.
+        """
+        ids = self.tokenizer(f"{speaker}: {text}\n", add_special_tokens=False)["input_ids"]
+        self.turns.append((speaker, text, ids))
+        self._prefill(self._turn_ids())
+
+    @torch.inference_mode()
+    def respond(self, max_new_tokens=None, temperature=None):
+        """
+        Generates the response speaker's next line, adds it to the window and
+        returns it.
+        """
+        max_new_tokens = self.max_new_tokens if max_new_tokens is None else max_new_tokens
+        temperature = self.temperature if temperature is None else temperature
+        cue = self.tokenizer(f"\n{self.response_speaker}:", add_special_tokens=False)["input_ids"]
+        logits = self._prefill(self._turn_ids() + cue)
+
+        generated, text = [], ""
+        temperature = torch.tensor([temperature], device=self.model.device)
+        top_p = torch.tensor([self.top_p], device=self.model.device)
+        while len(generated) < max_new_tokens:
+            token = int(sample_next_tokens(logits[None], temperature, top_p)[0])
+            if token in self.eos_token_ids:
+                break
+            generated.append(token)
+            text = self.tokenizer.decode(generated, skip_special_tokens=True)
+            if find_stop(text, self.stop_sequences) is not None:
+                break
+            logits = self._forward([token])
+
+        cut = find_stop(text, self.stop_sequences)
+        text = (text if cut is None else text[:cut]).strip()
+        self.add_turn(self.response_speaker, text)
+        return text
+
+    def stats(self):
+        return {
+            "turns": len(self.turns),
+            "cached_tokens": len(self._ids),
+            "processed_tokens": self.processed_tokens,
+            "reused_tokens": self.reused_tokens,
+        }
+
+    def _turn_ids(self):
+        return self.header_ids + [t for _, _, ids in self.turns for t in ids]
+
+    @torch.inference_mode()
+    def _prefill(self, ids):
+        """
+        Brings the KV cache to exactly `ids`, running only the tokens after
+        the prefix it shares with the cached ids, and returns the logits for
+        the position after `ids`.
+        """
+        shared = 0
+        for a, b in zip(self._ids, ids):
+            if a != b:
+                break
+            shared += 1
+        # At least one token has to run to produce logits.
+        shared = min(shared, len(ids) - 1)
+
+        if shared < len(self.header_ids) and self.prefix_cache is not None:
+            kv = self.prefix_cache.get_or_compute(self.model, self.header_ids)
+            self._cache = tensors_to_cache(kv, self.model.config)
+            self._ids = list(self.header_ids)
+            shared = len(self.header_ids)
+        elif self._cache is not None:
+            crop_cache(self._cache, shared)
+            self._ids = self._ids[:shared]
+
+        self.reused_tokens += shared
+        return self._forward(ids[shared:])
+
+    def _forward(self, ids):
+        out = self.model(
+            input_ids=torch.tensor([ids], device=self.model.device),
+            past_key_values=self._cache,
+            use_cache=True
+        )
+        self._cache = out.past_key_values
+        self._ids.extend(ids)
+        self.processed_tokens += len(ids)
+        return out.logits[0, -1]
@@ -0,0 +1,227 @@
+import json
+import time
+from pathlib import Path
+import torch
+from tqdm import tqdm
+from src.generation.cache_utils import crop_cache
+from src.generation.stopping import find_stop, dialogue_stop_sequences
+from src.util.build_prompt import build_prompt
+
+TARGET_MODEL_PATH = "models/lora_adapters/arthur_morgan"
+DRAFT_MODEL_PATH = "models/base/qwen2.5-0.5b"
+TEST_DATA_PATH = "data/summarized_splits/dialogue_pairs_test_summarized.jsonl"
+OUTPUT_PATH = "results/benchmarks/speculative.json"
+NUM_DRAFT_TOKENS = 4
+
+
+def _filtered_probs(logits, temperature, top_p):
+    """
+    Next-token distribution after temperature and nucleus filtering, the same
+    transformation applied to both the draft and the target.
+    """
+    probs = torch.softmax(logits.float() / max(temperature, 1e-5), dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    outside_nucleus = sorted_probs.cumsum(dim=-1) - sorted_probs > top_p
+    sorted_probs = sorted_probs.masked_fill(outside_nucleus, 0.0)
+    filtered = torch.zeros_like(probs).scatter(-1, sorted_idx, sorted_probs)
+    return filtered / filtered.sum(dim=-1, keepdim=True)
+
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding for one sequence at a time: the draft model proposes
+    `num_draft_tokens` tokens autoregressively and the target scores all of
+    them in a single forward pass. Greedy decoding accepts the longest prefix
+    the target agrees with; sampling uses the rejection rule of Leviathan et
+    al. (2023), so outputs follow the target distribution either way.
+
+    Both models must share a tokenizer (e.g. Qwen2.5-0.5B drafting for
+    Qwen2.5-3B). With num_draft_tokens=0 this is plain autoregressive
+    decoding of the target, which the benchmark uses as its baseline.
+    Acceptance counters accumulate across calls.
+    """
+    def __init__(self, target, draft, tokenizer, num_draft_tokens=NUM_DRAFT_TOKENS,
+                 max_length=1024, max_new_tokens=120, temperature=0.7, top_p=0.9):
+        self.target = target
+        self.draft = draft
+        self.tokenizer = tokenizer
+        self.num_draft_tokens = num_draft_tokens
+        self.max_length = max_length
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+
+        eos = target.generation_config.eos_token_id
+        eos = eos if isinstance(eos, (list, tuple)) else [eos]
+        self.eos_token_ids = {t for t in [*eos, tokenizer.eos_token_id] if t is not None}
+        self.vocab_size = target.config.vocab_size
+        if draft is not None:
+            self.vocab_size = min(self.vocab_size, draft.config.vocab_size)
+
+        self.proposed = 0
+        self.accepted = 0
+        self.target_passes = 0
+
+    def acceptance_rate(self):
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    def _pick(self, logits, temperature):
+        if temperature <= 0:
+            return int(logits.argmax())
+        return int(torch.multinomial(_filtered_probs(logits, temperature, self.top_p), 1))
+
+    @torch.inference_mode()
+    def generate(self, prompt, max_new_tokens=None, temperature=None, stop_sequences=()):
+        max_new_tokens = self.max_new_tokens if max_new_tokens is None else max_new_tokens
+        temperature = self.temperature if temperature is None else temperature
+        device = self.target.device
+
+        ids = self.tokenizer(prompt, truncation=True, max_length=self.max_length)["input_ids"]
+        prompt_len = len(ids)
+
+        # The target cache always covers exactly `ids`; `next_token` is the
+        # target's choice for the following position, not yet committed.
+        out = self.target(input_ids=torch.tensor([ids], device=device), use_cache=True)
+        self.target_passes += 1
+        target_cache = out.past_key_values
+        next_token = self._pick(out.logits[0, -1, :self.vocab_size], temperature)
+        draft_cache, draft_len = None, 0
+
+        text = ""
+        while next_token not in self.eos_token_ids and len(ids) - prompt_len < max_new_tokens:
+            ids.append(next_token)
+            text = self.tokenizer.decode(ids[prompt_len:], skip_special_tokens=True)
+            if find_stop(text, stop_sequences) is not None:
+                break
+
+            # Draft up to k tokens, feeding the draft whatever it has not seen.
+            k = min(self.num_draft_tokens, max_new_tokens - (len(ids) - prompt_len))
+            drafted, draft_probs = [], []
+            feed = ids[draft_len:]
+            for _ in range(k):
+                out = self.draft(
+                    input_ids=torch.tensor([feed], device=self.draft.device),
+                    past_key_values=draft_cache,
+                    use_cache=True
+                )
+                draft_cache = out.past_key_values
+                draft_len += len(feed)
+                logits = out.logits[0, -1, :self.vocab_size].to(device)
+                if temperature <= 0:
+                    token = int(logits.argmax())
+                else:
+                    probs = _filtered_probs(logits, temperature, self.top_p)
+                    token = int(torch.multinomial(probs, 1))
+                    draft_probs.append(probs)
+                drafted.append(token)
+                feed = [token]
+
+            # Score the newest token plus every draft in one target pass;
+            # logits[i] is the target's prediction after drafted[:i].
+            out = self.target(
+                input_ids=torch.tensor([[ids[-1]] + drafted], device=device),
+                past_key_values=target_cache,
+                use_cache=True
+            )
+            self.target_passes += 1
+            target_cache = out.past_key_values
+            logits = out.logits[0, :, :self.vocab_size]
+
+            accepted, next_token = 0, None
+            for i, token in enumerate(drafted):
+                if temperature <= 0:
+                    if int(logits[i].argmax()) != token:
+                        next_token = int(logits[i].argmax())
+                        break
+                else:
+                    p = _filtered_probs(logits[i], temperature, self.top_p)
+                    q = draft_probs[i]
+                    if torch.rand(()) >= torch.clamp(p[token] / q[token], max=1.0):
+                        residual = torch.clamp(p - q, min=0.0)
+                        residual = residual / residual.sum() if residual.sum() > 0 else p
+                        next_token = int(torch.multinomial(residual, 1))
+                        break
+                accepted += 1
+            if next_token is None:
+                next_token = self._pick(logits[len(drafted)], temperature)
+
+            self.proposed += len(drafted)
+            self.accepted += accepted
+
+            for token in drafted[:accepted]:
+                if token in self.eos_token_ids:
+                    next_token = token
+                    break
+                ids.append(token)
+            crop_cache(target_cache, len(ids))
+            if draft_cache is not None:
+                draft_len = min(draft_len, len(ids))
+                crop_cache(draft_cache, draft_len)
+
+        text = self.tokenizer.decode(ids[prompt_len:], skip_special_tokens=True)
+        cut = find_stop(text, stop_sequences)
+        return (text if cut is None else text[:cut]).strip()
+
+
+def load_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def benchmark(target, draft, tokenizer, examples, num_draft_tokens=NUM_DRAFT_TOKENS,
+              max_new_tokens=120, temperature=0.0):
+    """
+    Times plain target decoding against speculative decoding on the same
+    prompts and reports acceptance rate and speedup.
+    """
+    baseline = SpeculativeDecoder(target, None, tokenizer, num_draft_tokens=0,
+                                  max_new_tokens=max_new_tokens, temperature=temperature)
+    speculative = SpeculativeDecoder(target, draft, tokenizer, num_draft_tokens=num_draft_tokens,
+                                     max_new_tokens=max_new_tokens, temperature=temperature)
+    results = {"baseline": {"seconds": 0.0, "tokens": 0}, "speculative": {"seconds": 0.0, "tokens": 0}}
+    matches = 0
+    for ex in tqdm(examples, desc="Benchmarking"):
+        prompt, stops = build_prompt(ex), dialogue_stop_sequences(ex)
+        outputs = []
+        for name, decoder in (("baseline", baseline), ("speculative", speculative)):
+            start = time.perf_counter()
+            text = decoder.generate(prompt, stop_sequences=stops)
+            results[name]["seconds"] += time.perf_counter() - start
+            results[name]["tokens"] += len(tokenizer(text, add_special_tokens=False)["input_ids"])
+            outputs.append(text)
+        matches += outputs[0] == outputs[1]
+
+    for r in results.values():
+        r["tokens_per_second"] = r["tokens"] / r["seconds"] if r["seconds"] else 0.0
+    return {
+        "examples": len(examples),
+        "num_draft_tokens": num_draft_tokens,
+        "temperature": temperature,
+        "acceptance_rate": speculative.acceptance_rate(),
+        "accepted_per_target_pass": speculative.accepted / max(speculative.target_passes, 1),
+        "speedup": results["baseline"]["seconds"] / results["speculative"]["seconds"] if results["speculative"]["seconds"] else 0.0,
+        "identical_outputs": matches,
+        **results,
+    }
+
+def main():
+    from src.generation.inference import load_model
+
+    tokenizer, target = load_model(TARGET_MODEL_PATH)
+    _, draft = load_model(DRAFT_MODEL_PATH)
+
+    examples = load_jsonl(TEST_DATA_PATH)
+    report = benchmark(target, draft, tokenizer, examples)
+
+    Path(OUTPUT_PATH).parent.mkdir(parents=True, exist_ok=True)
+    with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+
+    print(f"Acceptance rate: {report['acceptance_rate']:.3f}")
+    print(f"Baseline: {report['baseline']['tokens_per_second']:.1f} tok/s, "
+          f"speculative: {report['speculative']['tokens_per_second']:.1f} tok/s "
+          f"({report['speedup']:.2f}x)")
+    print(f"Saved benchmark to {OUTPUT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
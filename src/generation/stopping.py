@@ -0,0 +1,43 @@
+# Section header the instruction-style prompts use; a reply never contains it.
+SECTION_MARKER = "###"
+
+
+def dialogue_stop_sequences(example):
+    """
+    Strings that mean the model has finished the reply for `example` and moved
+    on: a new "###" block, a closing or opening speaker tag, or the next
+    "Name:" turn.
+    """
+    speaker = example.get("speaker", "")
+    response_speaker = example.get("response_speaker", "")
+    stops = [SECTION_MARKER]
+    for name in (response_speaker, speaker):
+        if name:
+            stops += [f"</{name}>", f"<{name}>", f"\n{name}:"]
+    return list(dict.fromkeys(stops))
+
+def find_stop(text, stop_sequences):
+    """
+    Index of the earliest stop sequence in `text`, or None.
+    """
+    positions = [text.find(stop) for stop in stop_sequences]
+    positions = [p for p in positions if p != -1]
+    return min(positions) if positions else None
+
+def truncate_at_stop(text, stop_sequences):
+    cut = find_stop(text, stop_sequences)
+    return text if cut is None else text[:cut].rstrip()
+
+def stop_holdback(text, stop_sequences):
+    """
+    Length of the longest suffix of `text` that could still grow into a stop
+    sequence. Streaming holds that many characters back so a partial stop
+    string is never shown.
+    """
+    longest = 0
+    for stop in stop_sequences:
+        for n in range(min(len(stop) - 1, len(text)), longest, -1):
+            if stop.startswith(text[-n:]):
+                longest = n
+                break
+    return longest
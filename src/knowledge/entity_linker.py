@@ -0,0 +1,100 @@
+from collections import deque
+
+
+def is_boundary(text, i):
+    return i < 0 or i >= len(text) or not text[i].isalnum()
+
+
+class EntityLinker:
+    """
+    Finds mentions of knowledge-graph entities in text, by name or alias, in
+    a single pass. The names are compiled into an Aho-Corasick automaton, so
+    scanning takes time linear in the text (plus the matches found) however
+    many entities there are. Matches must start and end at word boundaries;
+    overlapping matches resolve to the leftmost, then longest, one, so
+    "John Marston" is not also read as "John".
+    """
+    def __init__(self, names, case_sensitive=True):
+        """
+        `names` maps each surface form (name or alias) to its entity.
+        """
+        self.case_sensitive = case_sensitive
+        self.goto = [{}]
+        self.fail = [0]
+        # Per state: (pattern length, entity) of every pattern ending there.
+        self.out = [[]]
+        for surface, entity in names.items():
+            self._add(self._fold(surface), entity)
+        self._link()
+
+    @classmethod
+    def from_graph(cls, graph, case_sensitive=True):
+        """
+        Linker over every node of `graph`, using each node's `aliases`
+        attribute as extra surface forms.
+        """
+        names = {}
+        for node, data in graph.nodes(data=True):
+            names[node] = node
+            for alias in data.get("aliases") or ():
+                names.setdefault(alias, node)
+        return cls(names, case_sensitive)
+
+    def _fold(self, text):
+        return text if self.case_sensitive else text.lower()
+
+    def _add(self, pattern, entity):
+        if not pattern:
+            return
+        state = 0
+        for ch in pattern:
+            if ch not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[state][ch] = len(self.goto) - 1
+            state = self.goto[state][ch]
+        self.out[state].append((len(pattern), entity))
+
+    def _link(self):
+        # Breadth-first, so a state's failure target is finished before it.
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self.goto[state].items():
+                queue.append(child)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f][ch] if state and ch in self.goto[f] else 0
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def matches(self, text):
+        """
+        Non-overlapping (start, end, entity) mentions in `text`, in order.
+        """
+        folded = self._fold(text)
+        found = []
+        state = 0
+        for i, ch in enumerate(folded):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for length, entity in self.out[state]:
+                start = i + 1 - length
+                if is_boundary(folded, start - 1) and is_boundary(folded, i + 1):
+                    found.append((start, i + 1, entity))
+
+        found.sort(key=lambda m: (m[0], m[0] - m[1]))
+        linked, end = [], 0
+        for match in found:
+            if match[0] >= end:
+                linked.append(match)
+                end = match[1]
+        return linked
+
+    def link(self, text):
+        """
+        Entities mentioned in `text`, each once, in order of first mention.
+        """
+        return list(dict.fromkeys(entity for _, _, entity in self.matches(text)))
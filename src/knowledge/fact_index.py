@@ -0,0 +1,116 @@
+import json
+import os
+from pathlib import Path
+import numpy as np
+from src.knowledge.retriever import KnowledgeGraphRetriever
+from src.memory.extractive_memory import MEMORY_MODEL, encode, load_encoder
+
+FACT_INDEX_PATH = "results/cache/fact_index.npz"
+
+
+def graph_facts(graph):
+    """
+    Every fact of `graph` as embeddable text, mapped to the entities it is
+    about: one per relationship, and one per entity description.
+    """
+    facts = {}
+    for s, t, data in graph.edges(data=True):
+        # Same text as the retriever's structural facts, which it dedupes against.
+        facts[KnowledgeGraphRetriever.format_fact(s, t, data)] = (s, t)
+    for node, data in graph.nodes(data=True):
+        if data.get("description"):
+            facts[f"{node}: {data['description']}"] = (node,)
+    return facts
+
+
+class FactIndex:
+    """
+    Embeddings of knowledge-graph facts in one normalized matrix, searched
+    by a single matrix product. Persisted at `path`; `update` embeds only
+    facts it has not seen, so adding lore re-embeds nothing else.
+    """
+    def __init__(self, encoder, path=FACT_INDEX_PATH, model_name=MEMORY_MODEL):
+        self.encoder = encoder
+        self.path = Path(path) if path is not None else None
+        self.model_name = model_name
+        self.texts = []
+        self.entities = []
+        self.vectors = np.zeros((0, encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+        self._rows = {}
+        if self.path is not None and self.path.exists():
+            self._load()
+
+    def _load(self):
+        with np.load(self.path, allow_pickle=False) as data:
+            # Vectors from another model are not comparable; start over.
+            if str(data["model_name"]) != self.model_name:
+                return
+            self.texts = [str(t) for t in data["texts"]]
+            self.entities = [tuple(e) for e in json.loads(str(data["entities"]))]
+            self.vectors = data["vectors"]
+        self._rows = {text: i for i, text in enumerate(self.texts)}
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.stem}.{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp,
+            model_name=np.array(self.model_name),
+            texts=np.array(self.texts, dtype=str),
+            entities=np.array(json.dumps(self.entities)),
+            vectors=self.vectors,
+        )
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def update(self, facts):
+        """
+        Brings the index to exactly `facts` ({text: entities}): embeds new
+        facts and drops ones no longer present. Returns the number embedded.
+        """
+        keep = [i for i, text in enumerate(self.texts) if text in facts]
+        new = [text for text in facts if text not in self._rows]
+        vectors = encode(self.encoder, new)
+
+        self.texts = [self.texts[i] for i in keep] + new
+        self.entities = [tuple(facts[text]) for text in self.texts]
+        self.vectors = np.concatenate([self.vectors[keep], vectors]) if len(keep) else vectors
+        self._rows = {text: i for i, text in enumerate(self.texts)}
+        return len(new)
+
+    def search(self, queries, top_k, entities=None):
+        """
+        The `top_k` facts most similar to each query, best first. With
+        `entities` (one collection per query), only facts about at least one
+        of the query's entities are considered.
+        """
+        if not len(self.texts) or not queries:
+            return [[] for _ in queries]
+        scores = encode(self.encoder, queries) @ self.vectors.T
+        if entities is not None:
+            for row, allowed in zip(scores, entities):
+                allowed = set(allowed)
+                row[[not allowed.intersection(e) for e in self.entities]] = -np.inf
+        k = min(top_k, scores.shape[1])
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, idx in zip(scores, best):
+            idx = idx[np.argsort(-row[idx], kind="stable")]
+            results.append([self.texts[i] for i in idx if np.isfinite(row[i])])
+        return results
+
+
+def load_fact_index(graph, encoder=None, path=FACT_INDEX_PATH):
+    """
+    The persisted index, updated to the facts currently in `graph` and
+    saved again if anything changed.
+    """
+    index = FactIndex(encoder or load_encoder(), path)
+    before = list(index.texts)
+    embedded = index.update(graph_facts(graph))
+    if path is not None and (embedded or index.texts != before):
+        index.save()
+    print(f"Fact index: {len(index)} facts, {embedded} newly embedded")
+    return index
@@ -1,72 +1,268 @@
 import re
+from collections import deque
+from src.knowledge.entity_linker import EntityLinker
 from src.knowledge.graph_builder import KnowledgeGraph
 
+ARTHUR = "Arthur Morgan"
+MISSION_FACT = "Mission Fact"
+INVOLVEMENT_FACT = "Arthur's Mission Involvement"
+CONTEXT_FACT = "Context Fact (Arthur's View)"
+RELATED_FACT = "Related Fact"
+SEMANTIC_FACT = "Relevant to the Conversation"
+
+# Facts beyond one hop, ranked by personalized PageRank from the turn's
+# entities: at most RELATED_FACTS of them, RELATED_FACT_TOKENS words in
+# total, within MAX_HOPS edges of a seed. RELATED_FACTS = 0 turns it off.
+RELATED_FACTS = 3
+RELATED_FACT_TOKENS = 80
+MAX_HOPS = 2
+PAGERANK_ALPHA = 0.15
+# Residual below which push-based PageRank stops spreading (per unit degree).
+PAGERANK_EPSILON = 1e-4
+# Best-scoring facts kept per seed; a seed set is ranked over their union.
+SEED_CANDIDATES = 32
+# Facts (or entity descriptions) added by similarity to the conversation.
+SEMANTIC_FACTS = 3
+
+
 class KnowledgeGraphRetriever:
-    def __init__(self):
-        self.kg = KnowledgeGraph()
+    """
+    Facts from Arthur's perspective for a dialogue turn. Every fact string is
+    formatted once when the retriever is built and indexed by its edge, so
+    retrieval is a handful of dictionary lookups however large the graph
+    gets. Call `build_index` again after changing `kg.graph`.
 
-    @staticmethod
-    def _extract_characters_from_context(context, excluded_nodes):
+    Besides Arthur's direct relationships, up to `related_facts` facts a few
+    hops from the speaker, target, mission and mentioned entities are added
+    (e.g. "Hosea Matthews DIED_DURING Banking, ..." when only Hosea is
+    mentioned), ranked by personalized PageRank from those seeds.
+    """
+    def __init__(self, kg=None, related_facts=RELATED_FACTS, related_fact_tokens=RELATED_FACT_TOKENS,
+                 max_hops=MAX_HOPS):
+        self.kg = kg if kg is not None else KnowledgeGraph()
+        self.related_facts = related_facts
+        self.related_fact_tokens = related_fact_tokens
+        self.max_hops = max_hops
+        # Changes whenever facts_for_key may return different facts for a key.
+        self.version = [getattr(self.kg, "version", None), related_facts, related_fact_tokens, max_hops]
+        self.build_index()
+
+    def build_index(self):
+        graph = self.kg.graph
+        # (source, target) -> fact, for every edge.
+        self.edge_facts = {
+            (s, t): self.format_fact(s, t, data) for s, t, data in graph.edges(data=True)
+        }
+        # Node -> its outgoing edges as mission facts.
+        self.mission_facts = {
+            node: [self.format_fact(s, t, data, prefix=MISSION_FACT) for s, t, data in graph.edges(node, data=True)]
+            for node in graph.nodes
+        }
+        # Arthur's edges, under the prefixes they are retrieved with.
+        arthur_edges = list(graph.edges(ARTHUR, data=True)) if graph.has_node(ARTHUR) else []
+        self.known_characters = frozenset(t for _, t, _ in arthur_edges)
+        self.involvement_facts = {
+            t: self.format_fact(s, t, data, prefix=INVOLVEMENT_FACT) for s, t, data in arthur_edges
+        }
+        self.context_facts = {
+            t: self.format_fact(s, t, data, prefix=CONTEXT_FACT) for s, t, data in arthur_edges
+        }
+        # Every node name and alias, for mentions outside the speaker tags.
+        self.linker = EntityLinker.from_graph(graph)
+
+        # Undirected neighbours for the PageRank walk. Arthur is left out: his
+        # edges are already retrieved directly, and as the hub he would spread
+        # every walk over the whole graph.
+        self.neighbors = {node: [] for node in graph.nodes if node != ARTHUR}
+        self.related_fact_index = {}
+        for s, t, data in graph.edges(data=True):
+            if ARTHUR in (s, t) or s == t:
+                continue
+            self.neighbors[s].append(t)
+            self.neighbors[t].append(s)
+            fact = self.format_fact(s, t, data, prefix=RELATED_FACT)
+            self.related_fact_index[(s, t)] = (fact, len(fact.split()))
+        self._seed_facts = {}
+        self._facts = {}
+
+    def _extract_characters_from_context(self, context, excluded_nodes):
         matches = re.findall(r'<([^/]+?)>', context)
         extracted = {name.strip() for name in matches if name.strip() not in excluded_nodes}
+        extracted.update(e for e in self.linker.link(context) if e not in excluded_nodes)
         return list(extracted)
     
     @staticmethod
-    def _format_fact(source, target, data, prefix=""):
+    def format_fact(source, target, data, prefix=""):
         fact = f"{source} {data['type']} {target}. Details: {data.get('details', 'N/A')}"
         if prefix:
             return f"{prefix}: {fact}"
         return fact
 
+    def fact_key(self, mission: str, context: str, speaker: str, target: str):
+        """
+        Everything get_relevant_facts depends on: the mission, speaker and
+        target, plus the entities tagged or mentioned (by name or alias) in
+        the context (sorted, as their order does not matter). Without related
+        facts only those Arthur has a relationship with matter; with them,
+        every linked entity seeds the PageRank walk. Examples with equal keys
+        get the same facts.
+        """
+        excluded = {speaker, target, ARTHUR, "action", mission}
+        context_characters = self._extract_characters_from_context(context, excluded)
+        relevant = self.neighbors if self.related_facts else self.known_characters
+        return (mission, speaker, target, tuple(sorted(c for c in context_characters if c in relevant)))
+
     def get_relevant_facts(self, mission: str, context: str, speaker: str, target: str):
         """
         Retrieves facts that connect the mission and the key characters 
         (speaker, target) from Arthur's perspective, using the context for 
         additional character mentions.
         """
-        relevant_facts = []
-
-        # Arthur's perspective on the current SPEAKER (e.g., Bill Williamson)
-        # Search: Arthur Morgan -> Relationship -> Speaker
-        for s, t, data in self.kg.graph.edges("Arthur Morgan", data=True):
-            if t == speaker:
-                relevant_facts.append(self._format_fact(s, t, data))
-
-        # Speaker-Target relationship (Direct connection)
-        if self.kg.graph.has_node(speaker) and self.kg.graph.has_node(target):
-            # Check for edge: Speaker -> Target
-            for s, t, data in self.kg.graph.edges(speaker, data=True):
-                if t == target:
-                    relevant_facts.append(self._format_fact(s, t, data))
-            
-            # Check for edge: Target -> Speaker
-            for s, t, data in self.kg.graph.edges(target, data=True):
-                if t == speaker:
-                    relevant_facts.append(self._format_fact(s, t, data))
-
-        # Mission Context (What is the Mission about, and Arthur's involvement)
-        # Search: Mission -> Relationship -> Entity
-        for s, t, data in self.kg.graph.edges(mission, data=True):
-            relevant_facts.append(self._format_fact(s, t, data, prefix="Mission Fact"))
-
-        # Search: Arthur Morgan -> Relationship -> Mission
-        for s, t, data in self.kg.graph.edges("Arthur Morgan", data=True):
-            if t == mission:
-                relevant_facts.append(self._format_fact(s, t, data, prefix="Arthur's Mission Involvement"))
-
-        # Contextually Relevant Character Facts
-        excluded = {speaker, target, "Arthur Morgan", "action"}
-        context_characters = self._extract_characters_from_context(context, excluded)
-        
-        for char in context_characters:
-            if self.kg.graph.has_node(char):
-                # Search: Arthur Morgan -> Relationship -> Context Character
-                for s, t, data in self.kg.graph.edges("Arthur Morgan", data=True):
-                    if t == char:
-                        relevant_facts.append(self._format_fact(s, t, data, prefix="Context Fact (Arthur's View)"))
+        return self.facts_for_key(self.fact_key(mission, context, speaker, target))
 
+    def get_relevant_facts_batch(self, examples):
+        """
+        get_relevant_facts for a batch of dataset examples.
+        """
+        return self.facts_for_keys([
+            self.fact_key(ex.get("mission"), ex.get("context"), ex["speaker"], ex["response_speaker"])
+            for ex in examples
+        ])
+
+    def get_semantic_facts_batch(self, examples, fact_index, top_k=SEMANTIC_FACTS, structural_filter=False):
+        """
+        The structural facts of each example plus the `top_k` entries of
+        `fact_index` (see fact_index.FactIndex) most similar to its context
+        and utterance. With `structural_filter`, those are limited to facts
+        about the example's own entities (mission, speakers and mentions).
+        """
+        keys = [
+            self.fact_key(ex.get("mission"), ex.get("context"), ex["speaker"], ex["response_speaker"])
+            for ex in examples
+        ]
+        structural = self.facts_for_keys(keys)
+        queries = [f"{ex.get('context', '')} {ex['speaker']}: {ex['utterance']}" for ex in examples]
+        entities = [(mission, speaker, target, *chars) for mission, speaker, target, chars in keys] \
+            if structural_filter else None
+        # Extra room for hits that are already among the structural facts.
+        found = fact_index.search(queries, top_k + max(map(len, structural), default=0), entities)
+
+        results = []
+        for facts, hits in zip(structural, found):
+            extra = [f"{SEMANTIC_FACT}: {h}" for h in hits if not any(f.endswith(h) for f in facts)]
+            results.append(facts + extra[:top_k])
+        return results
+
+    def facts_for_keys(self, keys):
+        return [self.facts_for_key(key) for key in keys]
+
+    def facts_for_key(self, key):
+        # Keys repeat across a dataset; the lists are shared, so callers must not modify them.
+        if key in self._facts:
+            return self._facts[key]
+        mission, speaker, target, context_characters = key
+        relevant_facts = [
+            # Arthur's perspective on the current SPEAKER (e.g., Bill Williamson)
+            self.edge_facts.get((ARTHUR, speaker)),
+            # Speaker-Target relationship, both directions
+            self.edge_facts.get((speaker, target)),
+            self.edge_facts.get((target, speaker)),
+            # Mission Context (What is the Mission about, and Arthur's involvement)
+            *self.mission_facts.get(mission, ()),
+            self.involvement_facts.get(mission),
+            # Contextually Relevant Character Facts
+            *(self.context_facts.get(char) for char in context_characters),
+        ]
         # Remove duplicates using the raw fact string as the key
-        return list(dict.fromkeys(relevant_facts))
+        facts = list(dict.fromkeys(f for f in relevant_facts if f is not None))
+        if self.related_facts:
+            seeds = [mission, speaker, target, *context_characters]
+            direct = {(speaker, target), (target, speaker)}
+            direct.update((mission, t) for t in self.neighbors.get(mission, ()))
+            facts += self.rank_related_facts(seeds, exclude=direct)
+        self._facts[key] = facts
+        return facts
+
+    def pagerank(self, seed):
+        """
+        Personalized PageRank from one node, as a sparse {node: score},
+        approximated by local push (Andersen, Chung & Lang) within
+        `max_hops` of the seed. Only the neighbourhood is touched, so the
+        cost does not grow with the graph.
+        """
+        hops = {seed: 0}
+        frontier = deque([seed])
+        while frontier:
+            node = frontier.popleft()
+            if hops[node] < self.max_hops:
+                for nbr in self.neighbors[node]:
+                    if nbr not in hops:
+                        hops[nbr] = hops[node] + 1
+                        frontier.append(nbr)
+
+        scores, residual = {}, {seed: 1.0}
+        queue = deque([seed])
+        while queue:
+            node = queue.popleft()
+            mass = residual.pop(node, 0.0)
+            nbrs = [n for n in self.neighbors[node] if n in hops]
+            if mass < PAGERANK_EPSILON * max(len(nbrs), 1):
+                if mass:
+                    residual[node] = mass
+                continue
+            if not nbrs:
+                scores[node] = scores.get(node, 0.0) + mass
+                continue
+            scores[node] = scores.get(node, 0.0) + PAGERANK_ALPHA * mass
+            share = (1 - PAGERANK_ALPHA) * mass / len(nbrs)
+            for nbr in nbrs:
+                residual[nbr] = residual.get(nbr, 0.0) + share
+                if residual[nbr] >= PAGERANK_EPSILON * len(self.neighbors[nbr]):
+                    queue.append(nbr)
+        return scores
+
+    def seed_facts(self, seed):
+        """
+        {edge: score} of the SEED_CANDIDATES best facts around `seed`, where a
+        fact scores the PageRank of both its ends. Cached per seed; a seed
+        set's scores are the mean of its seeds', since PageRank is linear in
+        the personalization.
+        """
+        if seed not in self._seed_facts:
+            scores = self.pagerank(seed)
+            candidates = {}
+            for node in scores:
+                for nbr in self.neighbors[node]:
+                    for edge in ((node, nbr), (nbr, node)):
+                        if edge in self.related_fact_index:
+                            candidates[edge] = scores.get(edge[0], 0.0) + scores.get(edge[1], 0.0)
+            best = sorted(candidates, key=candidates.get, reverse=True)[:SEED_CANDIDATES]
+            self._seed_facts[seed] = {edge: candidates[edge] for edge in best}
+        return self._seed_facts[seed]
+
+    def rank_related_facts(self, seeds, exclude=()):
+        """
+        Facts between entities near `seeds`, best first, scored by the seeds'
+        personalized PageRank (the mean of each seed's) at both ends, cut to
+        `related_facts` facts and `related_fact_tokens` words.
+        """
+        seeds = [s for s in dict.fromkeys(seeds) if s in self.neighbors]
+        candidates = {}
+        for seed in seeds:
+            for edge, score in self.seed_facts(seed).items():
+                if edge not in exclude:
+                    candidates[edge] = candidates.get(edge, 0.0) + score / len(seeds)
+
+        related, used = [], 0
+        for edge in sorted(candidates, key=candidates.get, reverse=True):
+            fact, length = self.related_fact_index[edge]
+            if used + length > self.related_fact_tokens:
+                continue
+            related.append(fact)
+            used += length
+            if len(related) == self.related_facts:
+                break
+        return related
 
 def main():
     example_data = {
@@ -0,0 +1,141 @@
+import re
+import numpy as np
+
+MEMORY_MODEL = "all-MiniLM-L6-v2"
+# Turns selected per prompt, and the budget they share (in tokens of
+# `count_tokens`, whitespace words by default).
+TOP_K = 5
+MEMORY_TOKEN_BUDGET = 160
+NO_MEMORY = "<no memory>"
+TURN_ENTRY = re.compile(r"<([^<>]+)> (.*?) </\1>")
+
+
+def load_encoder(model_name=MEMORY_MODEL, device=None):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    return SentenceTransformer(model_name, device=device)
+
+def parse_turns(context):
+    """
+    (speaker, text) pairs of a preprocessed context string.
+    """
+    return [(m.group(1), m.group(2)) for m in TURN_ENTRY.finditer(context)]
+
+def turn_text(speaker, text):
+    return f"{speaker}: {text}"
+
+def word_count(text):
+    return len(text.split())
+
+def encode(encoder, texts):
+    if not texts:
+        return np.zeros((0, encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+    return encoder.encode(texts, convert_to_numpy=True, normalize_embeddings=True,
+                          show_progress_bar=False).astype(np.float32)
+
+
+class ExtractiveMemory:
+    """
+    Conversation memory without an LLM: every past turn is embedded once
+    when it is added, and the memory for an utterance is the `top_k` turns
+    most similar to it that fit in `token_budget`, in conversation order.
+    Pass it to build_prompt in place of a generated memory summary.
+    """
+    def __init__(self, encoder, top_k=TOP_K, token_budget=MEMORY_TOKEN_BUDGET, count_tokens=word_count):
+        self.encoder = encoder
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.turns = []
+        self._last_text = None
+        self.lengths = []
+        self.vectors = np.zeros((0, encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+        self._size = 0
+        self._last = None
+
+    def __len__(self):
+        return self._size
+
+    def add_turn(self, speaker, text):
+        self.add_turns([(speaker, text)])
+
+    def add_turns(self, turns, vectors=None):
+        """
+        Adds (speaker, text) turns; `vectors` are their embeddings if already
+        computed.
+        """
+        texts = [turn_text(speaker, text) for speaker, text in turns]
+        if vectors is None:
+            vectors = encode(self.encoder, texts)
+        needed = self._size + len(texts)
+        if needed > len(self.vectors):
+            # Grow geometrically so adding a turn stays amortized O(1).
+            grown = np.zeros((max(needed, 2 * len(self.vectors), 16), self.vectors.shape[1]), dtype=np.float32)
+            grown[:self._size] = self.vectors[:self._size]
+            self.vectors = grown
+        self.vectors[self._size:needed] = vectors
+        self.turns += texts
+        if turns:
+            self._last_text = turns[-1][1]
+        self.lengths += [self.count_tokens(t) for t in texts]
+        self._size = needed
+        self._last = None
+
+    def select(self, query, query_vector=None):
+        """
+        Indices of the turns kept for `query`, in conversation order. Turns
+        are taken by similarity until `top_k` are kept; one that would exceed
+        the budget is skipped in favour of shorter, less similar ones. The
+        latest turn is left out when it is the query itself (a dataset
+        context ends with the utterance), as the prompt already has it.
+        """
+        size = self._size - 1 if self._last_text == query else self._size
+        if size <= 0:
+            return []
+        if query_vector is None:
+            query_vector = encode(self.encoder, [query])[0]
+        scores = self.vectors[:size] @ query_vector
+        kept, used = [], 0
+        for i in np.argsort(-scores, kind="stable"):
+            if used + self.lengths[i] <= self.token_budget:
+                kept.append(int(i))
+                used += self.lengths[i]
+                if len(kept) == self.top_k:
+                    break
+        return sorted(kept)
+
+    def summary(self, query, query_vector=None):
+        # build_prompt asks for the prompt prefixes more than once per example.
+        if self._last is not None and self._last[0] == query:
+            return self._last[1]
+        kept = self.select(query, query_vector)
+        summary = "\n".join(self.turns[i] for i in kept) if kept else NO_MEMORY
+        self._last = (query, summary)
+        return summary
+
+
+def extractive_memory_batch(examples, encoder, top_k=TOP_K, token_budget=MEMORY_TOKEN_BUDGET,
+                            count_tokens=word_count, cache=None):
+    """
+    Extractive memory summaries for dataset examples, each over the turns of
+    its own context for its utterance. Overlapping context windows repeat
+    turns, so embeddings are shared through `cache` ({turn text: vector})
+    and each distinct turn is encoded once per cache.
+    """
+    cache = {} if cache is None else cache
+    turns = [parse_turns(ex["context"]) for ex in examples]
+    new = list(dict.fromkeys(
+        turn_text(*t) for ts in turns for t in ts if turn_text(*t) not in cache
+    ))
+    cache.update(zip(new, encode(encoder, new)))
+    queries = encode(encoder, [ex["utterance"] for ex in examples])
+
+    summaries = []
+    for ex, ts, query_vector in zip(examples, turns, queries):
+        memory = ExtractiveMemory(encoder, top_k, token_budget, count_tokens)
+        if ts:
+            memory.add_turns(ts, np.stack([cache[turn_text(*t)] for t in ts]))
+        summaries.append(memory.summary(ex["utterance"], query_vector))
+    return summaries
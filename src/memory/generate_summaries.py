@@ -1,9 +1,20 @@
+import argparse
 import json
+import re
+from collections import defaultdict
 from pathlib import Path
 from tqdm import tqdm
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from src.knowledge.retriever import KnowledgeGraphRetriever
+from src.generation.prefix_cache import PrefixCache
+from src.generation.batching import generate_batched
+from src.memory.summary_store import SummaryStore
+from src.memory.knowledge_table import KNOWLEDGE_TABLE_PATH, KnowledgeTable, example_fact_key, table_version
+from src.memory.work_queue import WorkQueue
+from src.memory.extractive_memory import extractive_memory_batch, load_encoder
+from src.knowledge.fact_index import load_fact_index
+from src.generation.checkpoint import atomic_write_jsonl
 
 
 BASE_MODEL_PATH = "models/base/qwen2.5-3b"
@@ -14,6 +25,63 @@ OUTPUT_DIR = "data/summarized_splits"
 TRAIN_FILE = f"{INPUT_DIR}/dialogue_pairs_train.jsonl"
 VAL_FILE = f"{INPUT_DIR}/dialogue_pairs_val.jsonl"
 TEST_FILE = f"{INPUT_DIR}/dialogue_pairs_test.jsonl"
+SPLITS = {
+    "train": (TRAIN_FILE, f"{OUTPUT_DIR}/dialogue_pairs_train_summarized.jsonl"),
+    "val": (VAL_FILE, f"{OUTPUT_DIR}/dialogue_pairs_val_summarized.jsonl"),
+    "test": (TEST_FILE, f"{OUTPUT_DIR}/dialogue_pairs_test_summarized.jsonl"),
+}
+# Finished work units and their leases. Point several workers (processes or
+# machines sharing the filesystem) at the same directory to split the work.
+WORK_DIR = f"{OUTPUT_DIR}/work"
+UNIT_SIZE = 256
+MEMORY_UNIT = "memory"
+
+# Unshuffled output of preprocess_all_missions; incremental memory needs the
+# pairs of each mission in script order.
+DIALOGUE_PAIRS_FILE = "data/processed/dialogue_pairs.jsonl"
+
+# "llm" summarizes the context with the model; "extractive" keeps the context
+# turns most similar to the utterance (see extractive_memory), with no LLM call.
+MEMORY_BACKEND = "llm"
+
+# Summarize each mission incrementally instead of every 10-turn window.
+INCREMENTAL_MEMORY = True
+# New turns collected before a mission's rolling summary is updated; pairs
+# in between get the latest summary plus the turns it does not cover yet.
+MEMORY_UPDATE_TURNS = 4
+
+# Add the KG facts most similar to each turn (see knowledge.fact_index). The
+# facts then depend on the utterance, so the knowledge table is not used.
+SEMANTIC_KNOWLEDGE = False
+
+# Summaries already generated for a prompt are reused from here by every
+# split and every later run.
+SUMMARY_STORE_PATH = f"{OUTPUT_DIR}/summary_store.jsonl"
+# Bump when the prompt templates, model or decoding settings change so stored
+# summaries are regenerated.
+SUMMARY_TEMPLATE_VERSION = 1
+
+# Padded prompt + generated tokens allowed in one generate() call.
+MAX_BATCH_TOKENS = 8192
+
+MEMORY_PROMPT_PREFIX = (
+    "Summarize this dialogue in 2-3 sentences, focusing on the emotional tone, "
+    "character motivations, and key facts:\n\n"
+)
+MEMORY_UPDATE_PROMPT_PREFIX = (
+    "Update this dialogue summary with the new lines. Keep it to 2-3 sentences, focusing on "
+    "the emotional tone, character motivations, and key facts:\n\n"
+)
+KNOWLEDGE_PROMPT_PREFIX = (
+    "You are Arthur Morgan from Red Dead Redemption 2. Based on these facts about your world, "
+    "write 2-3 sentences describing your perspective and feelings.\n\n"
+)
+
+# One context entry as written by preprocess_dialogue, e.g. "<action> ... </action>".
+CONTEXT_ENTRY = re.compile(r"<([^<>]+)> .*? </\1>")
+
+# KV states of the fixed instruction prefixes, shared by every batch.
+prefix_cache = PrefixCache(max_entries=4)
 
 Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
 
@@ -24,6 +92,7 @@ def load_jsonl(path):
 def load_model():
     tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_PATH)
     tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
 
     model = AutoModelForCausalLM.from_pretrained(
         BASE_MODEL_PATH,
@@ -34,37 +103,41 @@ def load_model():
     return tokenizer, model
 
 def run_model(tokenizer, model, prompt):
-    inputs = tokenizer(prompt, return_tensors="pt").to("cuda")
-    outputs = model.generate(
-        **inputs,
-        max_new_tokens=120,
+    return run_model_batch(tokenizer, model, [prompt])[0]
+
+def run_model_batch(tokenizer, model, prompts, max_new_tokens=120, prefix=None, store=None):
+    """
+    Generates for a batch of prompts in length-bucketed, left-padded batches.
+    Prompts starting with `prefix` reuse its cached KV states and only
+    prefill their suffix. With a SummaryStore, repeated prompts and prompts
+    summarized before are answered from it; only the unique new ones are
+    generated.
+    """
+    if store is None:
+        return _generate(tokenizer, model, prompts, max_new_tokens, prefix)
+
+    keys = [SummaryStore.key(p, SUMMARY_TEMPLATE_VERSION) for p in prompts]
+    unique = dict(zip(keys, prompts))
+    results = {k: store.get(k) for k in unique}
+    todo = [k for k, summary in results.items() if summary is None]
+    if todo:
+        generated = dict(zip(todo, _generate(tokenizer, model, [unique[k] for k in todo], max_new_tokens, prefix)))
+        store.put_many(generated)
+        results.update(generated)
+    return [results[k] for k in keys]
+
+def _generate(tokenizer, model, prompts, max_new_tokens, prefix):
+    return generate_batched(
+        model,
+        tokenizer,
+        prompts,
+        max_new_tokens=max_new_tokens,
+        max_batch_tokens=MAX_BATCH_TOKENS,
+        prefix=prefix,
+        prefix_cache=prefix_cache,
         temperature=0.7,
         top_p=0.9
     )
-    decoded = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    return decoded[len(prompt):].strip()
-
-def run_model_batch(tokenizer, model, prompts, max_new_tokens=120):
-    inputs = tokenizer(
-        prompts,
-        return_tensors="pt",
-        padding=True,
-        return_attention_mask=True
-    ).to("cuda")
-
-    with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            temperature=0.7,
-            top_p=0.9
-        )
-    
-    input_length = inputs['input_ids'].shape[1]
-    generated_ids = outputs[:, input_length:]
-    decoded = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
-
-    return [out.strip() for out in decoded]
 
 def summarize_memory(context, tokenizer, model):
     if not context.strip():
@@ -76,21 +149,106 @@ def summarize_memory(context, tokenizer, model):
     )
     return run_model(tokenizer, model, prompt)
 
-def summarize_memory_batch(contexts, tokenizer, model):
+def summarize_memory_batch(contexts, tokenizer, model, store=None):
     prompts = []
     for ctx in contexts:
         if not ctx.strip():
             prompts.append("<no memory>:\n\nRespond with N/A")
         else:
             prompts.append(
-                "Summarize this dialogue in 2-3 sentences, focusing on the emotional tone, "
-                "character motivations, and key facts:\n\n"
+                MEMORY_PROMPT_PREFIX +
                 f"{ctx}\n\n"
                 "Summary:"
             )
-    summaries = run_model_batch(tokenizer, model, prompts)
+    summaries = run_model_batch(tokenizer, model, prompts, prefix=MEMORY_PROMPT_PREFIX, store=store)
     return summaries
 
+def context_entries(context):
+    return [m.group(0) for m in CONTEXT_ENTRY.finditer(context)]
+
+def added_entries(previous, current):
+    """
+    Entries of `current` that were not in `previous`, for consecutive pairs
+    whose context window slid forward. Windows that do not overlap count as
+    entirely new.
+    """
+    for shift in range(len(previous) + 1):
+        overlap = previous[shift:]
+        if current[:len(overlap)] == overlap:
+            return current[len(overlap):]
+    return current
+
+def plan_memory_updates(examples, update_turns=MEMORY_UPDATE_TURNS):
+    """
+    Groups pairs (in script order) by mission and decides when each
+    mission's rolling summary is updated. Returns, per mission, the entries
+    each update adds and, per (mission, context), the index of the update
+    whose summary it uses (None before the first one) and the newer entries
+    that summary does not cover, without the pair's own utterance.
+    """
+    updates = defaultdict(list)
+    uses = {}
+    previous, pending = {}, defaultdict(list)
+    for ex in examples:
+        mission, entries = ex["mission"], context_entries(ex["context"])
+        pending[mission] += added_entries(previous.get(mission, []), entries)
+        previous[mission] = entries
+        first = not updates[mission]
+        if pending[mission] and (first or len(pending[mission]) >= update_turns):
+            updates[mission].append(pending.pop(mission))
+        utterance = f"<{ex['speaker']}> {ex['utterance']} </{ex['speaker']}>"
+        uses[(mission, ex["context"])] = (
+            len(updates[mission]) - 1 if updates[mission] else None,
+            [e for e in pending[mission] if e != utterance],
+        )
+    return updates, uses
+
+def build_memory_table(examples, tokenizer, model, update_turns=MEMORY_UPDATE_TURNS, store=None):
+    """
+    Rolling conversation memory for pairs given in script order. Each
+    mission's summary is written once from its first turns and then updated
+    with only the turns added since, instead of summarizing every 10-turn
+    window from scratch. Missions are independent, so the k-th update of
+    every mission runs in one batch. Pairs between two updates get the
+    latest summary followed by the turns it does not cover yet, so the
+    turns just before the utterance are never missing from the prompt.
+
+    Returns {(mission, context): memory}.
+    """
+    updates, uses = plan_memory_updates(examples, update_turns)
+    summaries = {mission: [] for mission in updates}
+    prompt_tokens = 0
+    for step in range(max((len(u) for u in updates.values()), default=0)):
+        missions = [m for m in updates if len(updates[m]) > step]
+        prompts = []
+        for mission in missions:
+            new_lines = " ".join(updates[mission][step])
+            if step == 0:
+                prompts.append(MEMORY_PROMPT_PREFIX + f"{new_lines}\n\nSummary:")
+            else:
+                prompts.append(
+                    MEMORY_UPDATE_PROMPT_PREFIX +
+                    f"Summary so far:\n{summaries[mission][-1]}\n\n"
+                    f"New lines:\n{new_lines}\n\n"
+                    "Updated summary:"
+                )
+        prefix = MEMORY_PROMPT_PREFIX if step == 0 else MEMORY_UPDATE_PROMPT_PREFIX
+        prompt_tokens += sum(len(ids) for ids in tokenizer(prompts)["input_ids"])
+        for mission, summary in zip(missions, run_model_batch(tokenizer, model, prompts, prefix=prefix, store=store)):
+            summaries[mission].append(summary)
+
+    calls = sum(len(u) for u in updates.values())
+    memory = {}
+    for key, (index, recent) in uses.items():
+        summary = "<no memory>" if index is None else summaries[key[0]][index]
+        memory[key] = f"{summary}\nLatest lines: {' '.join(recent)}" if recent else summary
+    recent_tokens = sum(
+        len(tokenizer(" ".join(recent))["input_ids"]) for _, recent in uses.values() if recent
+    )
+    print(f"Incremental memory: {calls} summaries ({prompt_tokens} prompt tokens) for {len(uses)} contexts, "
+          f"{recent_tokens} tokens of not-yet-summarized lines added to their prompts")
+    return memory
+
 def summarize_knowledge(example, retriever, tokenizer, model):
     facts = retriever.get_relevant_facts(
         mission=example.get("mission"),
@@ -112,78 +270,181 @@ def summarize_knowledge(example, retriever, tokenizer, model):
 
     return run_model(tokenizer, model, prompt)
 
-def summarize_knowledge_batch(examples, retriever, tokenizer, model):
-    prompts = []
-    for example in examples:
-        facts = retriever.get_relevant_facts(
-            mission=example.get("mission"),
-            context=example.get("context"),
-            speaker=example["speaker"],
-            target=example["response_speaker"]
-        )
-        if not facts:
-            prompts.append("<no relevant facts>\n\nRespond with N/A")
-        else:
-            fact_text = "\n".join(facts)
-            prompts.append(
-                f"You are Arthur Morgan from Red Dead Redemption 2. Based on these facts about your world, "
-                "write 2-3 sentences describing your perspective and feelings.\n\n"
-                f"Facts:\n{fact_text}\n\n"
-                f"Arthur's perspective:"
-            )
+def knowledge_prompt(facts):
+    if not facts:
+        return "<no relevant facts>\n\nRespond with N/A"
+    fact_text = "\n".join(facts)
+    return (
+        KNOWLEDGE_PROMPT_PREFIX +
+        f"Facts:\n{fact_text}\n\n"
+        f"Arthur's perspective:"
+    )
 
-    summaries = run_model_batch(tokenizer, model, prompts)
-    return summaries
+def summarize_knowledge_batch(examples, retriever, tokenizer, model, store=None, table=None, fact_index=None):
+    """
+    Knowledge summaries for a batch of examples. With a KnowledgeTable,
+    precomputed summaries are looked up by fact key and only unseen keys are
+    generated (and added to the table). With a FactIndex, semantically
+    retrieved facts are added and every example is summarized (through the
+    store).
+    """
+    if fact_index is not None:
+        prompts = [knowledge_prompt(facts) for facts in retriever.get_semantic_facts_batch(examples, fact_index)]
+        return run_model_batch(tokenizer, model, prompts, prefix=KNOWLEDGE_PROMPT_PREFIX, store=store)
 
-def process_splits(path, output_path, retriever, tokenizer, model, batch_size=4):
-    data = load_jsonl(path)
-    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    keys = [example_fact_key(retriever, ex) for ex in examples]
+    summaries = [table.get(k) if table is not None else None for k in keys]
+    todo = list(dict.fromkeys(k for k, summary in zip(keys, summaries) if summary is None))
+    if todo:
+        prompts = [knowledge_prompt(facts) for facts in retriever.facts_for_keys(todo)]
+        generated = dict(zip(todo, run_model_batch(tokenizer, model, prompts, prefix=KNOWLEDGE_PROMPT_PREFIX, store=store)))
+        if table is not None:
+            table.update(generated)
+        summaries = [generated[k] if summary is None else summary for k, summary in zip(keys, summaries)]
+    return summaries
 
-    print(f"Generating summaries for: {path}")
-    with open(output_path, "w", encoding="utf-8") as out_f:
-        for i in tqdm(range(0, len(data), batch_size)):
-            batch = data[i:i + batch_size]
+def summarize_examples(data, retriever, tokenizer, model, batch_size=32, memory_table=None, store=None,
+                       knowledge_table=None, memory_encoder=None, fact_index=None):
+    """
+    Yields the examples of `data` with memory and knowledge summaries added,
+    one batch at a time. With a `memory_encoder` the memory is extractive.
+    """
+    turn_vectors = {}
+    for i in tqdm(range(0, len(data), batch_size)):
+        batch = data[i:i + batch_size]
 
+        if memory_encoder is not None:
+            memory_summaries = extractive_memory_batch(batch, memory_encoder, cache=turn_vectors)
+        elif memory_table is None:
             contexts = [ex['context'] for ex in batch]
             memory_summaries = summarize_memory_batch(
-                contexts, tokenizer, model
+                contexts, tokenizer, model, store
             )
+        else:
+            # Pairs missing from the ordered file fall back to their own window.
+            keys = [(ex["mission"], ex["context"]) for ex in batch]
+            missing = [k[1] for k in keys if k not in memory_table]
+            fallback = iter(summarize_memory_batch(missing, tokenizer, model, store) if missing else [])
+            memory_summaries = [memory_table[k] if k in memory_table else next(fallback) for k in keys]
 
-            kg_summaries = summarize_knowledge_batch(
-                batch, retriever, tokenizer, model
-            )
+        kg_summaries = summarize_knowledge_batch(
+            batch, retriever, tokenizer, model, store, knowledge_table, fact_index
+        )
 
-            for ex, mem_sum, kg_sum in zip(batch, memory_summaries, kg_summaries):
-                ex_out = dict(ex)
-                ex_out["memory_summary"] = mem_sum
-                ex_out["knowledge_summary"] = kg_sum
+        records = []
+        for ex, mem_sum, kg_sum in zip(batch, memory_summaries, kg_summaries):
+            ex_out = dict(ex)
+            ex_out["memory_summary"] = mem_sum
+            ex_out["knowledge_summary"] = kg_sum
+            records.append(ex_out)
+        yield records
 
-                out_f.write(json.dumps(ex_out) + "\n")
-            out_f.flush()
-    
-    print(f"Saved summarized dataset to {output_path}")
+def split_units(splits=SPLITS, unit_size=UNIT_SIZE):
+    """
+    Cuts every split into work units of `unit_size` consecutive examples.
+    Returns {unit name: (split, start, end)} in split and file order.
+    """
+    units = {}
+    for split, (path, _) in splits.items():
+        n = sum(1 for _ in open(path, "r", encoding="utf-8"))
+        for start in range(0, n, unit_size):
+            units[f"{split}-{start // unit_size:05d}"] = (split, start, min(start + unit_size, n))
+    return units
 
-def main():
-    tokenizer, model = load_model()
-    # tokenizer, model = None, None
+def load_memory_table(queue, tokenizer, model, store):
+    """
+    The incremental memory table is one unit of its own: the first worker
+    builds it and the others wait for its output. Building takes far longer
+    than a lease, so the lease is renewed throughout.
+    """
+    if queue.claim(MEMORY_UNIT) or queue.wait_for(MEMORY_UNIT):
+        try:
+            with queue.heartbeat(MEMORY_UNIT):
+                table = build_memory_table(load_jsonl(DIALOGUE_PAIRS_FILE), tokenizer, model, store=store)
+        except BaseException:
+            queue.release(MEMORY_UNIT)
+            raise
+        queue.complete(MEMORY_UNIT, [
+            {"mission": mission, "context": context, "summary": summary}
+            for (mission, context), summary in table.items()
+        ])
+    return {(r["mission"], r["context"]): r["summary"] for r in queue.read(MEMORY_UNIT)}
+
+def run_worker(queue, units, batch_size=32):
+    """
+    Claims and summarizes units until none are left. Each finished unit is
+    written as its own shard, so a crash only loses the unit in progress.
+    """
+    incremental = INCREMENTAL_MEMORY and MEMORY_BACKEND == "llm"
+    if not queue.pending() and (queue.done(MEMORY_UNIT) or not incremental):
+        return
 
+    tokenizer, model = load_model()
     retriever = KnowledgeGraphRetriever()
+    store = SummaryStore(SUMMARY_STORE_PATH)
 
-    process_splits(
-        TRAIN_FILE,
-        f"{OUTPUT_DIR}/dialogue_pairs_train_summarized.jsonl",
-        retriever, tokenizer, model
-    )
-    process_splits(
-        VAL_FILE,
-        f"{OUTPUT_DIR}/dialogue_pairs_val_summarized.jsonl",
-        retriever, tokenizer, model
-    )
-    process_splits(
-        TEST_FILE,
-        f"{OUTPUT_DIR}/dialogue_pairs_test_summarized.jsonl",
-        retriever, tokenizer, model
-    )
+    # Built offline by `python -m src.memory.knowledge_table`; keys it lacks
+    # are summarized here and kept in the summary store.
+    knowledge_table = None
+    if Path(KNOWLEDGE_TABLE_PATH).exists():
+        knowledge_table = KnowledgeTable.load()
+        if knowledge_table.version != table_version(retriever):
+            knowledge_table = None
+
+    memory_table = load_memory_table(queue, tokenizer, model, store) if incremental else None
+    memory_encoder = load_encoder() if MEMORY_BACKEND == "extractive" else None
+    fact_index = load_fact_index(retriever.kg.graph, memory_encoder) if SEMANTIC_KNOWLEDGE else None
+
+    data = {}
+    while (unit := queue.claim_next()) is not None:
+        split, start, end = units[unit]
+        if split not in data:
+            data[split] = load_jsonl(SPLITS[split][0])
+        print(f"{queue.worker_id}: summarizing {unit}")
+        records = []
+        try:
+            for batch in summarize_examples(data[split][start:end], retriever, tokenizer, model, batch_size,
+                                            memory_table, store, knowledge_table, memory_encoder,
+                                            fact_index):
+                records.extend(batch)
+                queue.renew(unit)
+        except BaseException:
+            queue.release(unit)
+            raise
+        queue.complete(unit, records)
+
+    print(f"Summary store: {store.stats()}")
+    if knowledge_table is not None:
+        print(f"Knowledge table: {knowledge_table.stats()}")
+    store.close()
+
+def merge_splits(queue, units):
+    """
+    Concatenates finished units into each split's output file in the
+    original order. Splits with unfinished units are left alone.
+    """
+    for split, (_, output_path) in SPLITS.items():
+        split_units = [u for u, (s, _, _) in units.items() if s == split]
+        missing = [u for u in split_units if not queue.done(u)]
+        if missing:
+            print(f"{split}: {len(missing)} of {len(split_units)} units unfinished, not merged")
+            continue
+        atomic_write_jsonl(output_path, [r for u in split_units for r in queue.read(u)])
+        print(f"Saved summarized dataset to {output_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate memory and knowledge summaries for every split.")
+    parser.add_argument("--merge-only", action="store_true", help="Only merge finished units.")
+    parser.add_argument("--no-merge", action="store_true", help="Only work on units; another process merges.")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    units = split_units(SPLITS, UNIT_SIZE)
+    queue = WorkQueue(WORK_DIR, units)
+    if not args.merge_only:
+        run_worker(queue, units, args.batch_size)
+    if not args.no_merge:
+        merge_splits(queue, units)
 
 if __name__ == "__main__":
     main()
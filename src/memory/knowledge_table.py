@@ -0,0 +1,168 @@
+import json
+import os
+from pathlib import Path
+from tqdm import tqdm
+from src.knowledge.retriever import KnowledgeGraphRetriever
+from src.memory.summary_store import SummaryStore
+
+KNOWLEDGE_TABLE_PATH = "data/summarized_splits/knowledge_table.json"
+# Files whose examples define the fact keys worth precomputing.
+SOURCE_FILES = [
+    "data/processed/dialogue_pairs.jsonl",
+    "data/splits/dialogue_pairs_train.jsonl",
+    "data/splits/dialogue_pairs_val.jsonl",
+    "data/splits/dialogue_pairs_test.jsonl",
+]
+KEY_SEPARATOR = "\t"
+
+
+def example_fact_key(retriever, example):
+    return retriever.fact_key(
+        mission=example.get("mission"),
+        context=example.get("context"),
+        speaker=example["speaker"],
+        target=example["response_speaker"]
+    )
+
+def key_to_str(key):
+    # Entity names can contain commas (mission titles), so every part is tab-separated.
+    mission, speaker, target, characters = key
+    return KEY_SEPARATOR.join([mission or "", speaker, target, *characters])
+
+def str_to_key(text):
+    mission, speaker, target, *characters = text.split(KEY_SEPARATOR)
+    return (mission, speaker, target, tuple(characters))
+
+
+class KnowledgeTable:
+    """
+    Knowledge summaries precomputed per fact key (see
+    KnowledgeGraphRetriever.fact_key), so serving a request is a dictionary
+    lookup. Keys missing from the table are generated on demand by
+    summarize_knowledge_batch and added; `save` writes them back.
+    """
+    def __init__(self, entries=None, version=None):
+        self.entries = dict(entries or {})
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, path=KNOWLEDGE_TABLE_PATH):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls({str_to_key(k): v for k, v in data["entries"].items()}, data.get("version"))
+
+    def save(self, path=KNOWLEDGE_TABLE_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": self.version,
+                "entries": {key_to_str(k): v for k, v in sorted(self.entries.items())},
+            }, f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        summary = self.entries.get(key)
+        if summary is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return summary
+
+    def update(self, summaries):
+        self.entries.update(summaries)
+
+    def coverage(self, retriever, examples):
+        """
+        Share of `examples` (and of their distinct fact keys) the table
+        answers without an LLM call.
+        """
+        keys = [example_fact_key(retriever, ex) for ex in examples]
+        distinct = set(keys)
+        return {
+            "examples": len(keys),
+            "examples_covered": sum(k in self.entries for k in keys) / len(keys) if keys else 0.0,
+            "keys": len(distinct),
+            "keys_covered": sum(k in self.entries for k in distinct) / len(distinct) if distinct else 0.0,
+        }
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def table_version(retriever):
+    """
+    Summaries stay valid while both the prompt templates and the facts the
+    retriever returns per key are unchanged.
+    """
+    from src.memory.generate_summaries import SUMMARY_TEMPLATE_VERSION
+
+    return [SUMMARY_TEMPLATE_VERSION, *retriever.version]
+
+def reachable_keys(retriever, examples):
+    """
+    Fact keys the dataset can produce: every example's own key, plus the key
+    without context characters for each (mission, speaker, target) seen, which
+    covers new conversations in a known scene before other characters are
+    mentioned.
+    """
+    keys = {}
+    for ex in examples:
+        key = example_fact_key(retriever, ex)
+        keys[key] = None
+        keys[key[:3] + ((),)] = None
+    return list(keys)
+
+def build_table(retriever, examples, tokenizer, model, store=None, batch_size=256, table=None):
+    """
+    Generates summaries for every reachable key not already in `table`.
+    """
+    # generate_summaries imports this module, so its helpers are imported here.
+    from src.memory.generate_summaries import (
+        KNOWLEDGE_PROMPT_PREFIX, knowledge_prompt, run_model_batch
+    )
+
+    version = table_version(retriever)
+    if table is None or table.version != version:
+        table = KnowledgeTable(version=version)
+    todo = [k for k in reachable_keys(retriever, examples) if k not in table]
+    print(f"{len(table)} knowledge summaries present, {len(todo)} to generate")
+    for i in tqdm(range(0, len(todo), batch_size)):
+        batch = todo[i:i + batch_size]
+        prompts = [knowledge_prompt(facts) for facts in retriever.facts_for_keys(batch)]
+        table.update(zip(batch, run_model_batch(tokenizer, model, prompts, prefix=KNOWLEDGE_PROMPT_PREFIX, store=store)))
+    return table
+
+def main():
+    from src.memory.generate_summaries import SUMMARY_STORE_PATH, load_jsonl, load_model
+
+    examples = [ex for path in SOURCE_FILES if Path(path).exists() for ex in load_jsonl(path)]
+    retriever = KnowledgeGraphRetriever()
+    table = KnowledgeTable.load() if Path(KNOWLEDGE_TABLE_PATH).exists() else None
+
+    tokenizer, model = load_model()
+    store = SummaryStore(SUMMARY_STORE_PATH)
+    table = build_table(retriever, examples, tokenizer, model, store=store, table=table)
+    store.close()
+    table.save()
+
+    print(f"Coverage: {table.coverage(retriever, examples)}")
+    print(f"Saved {len(table)} knowledge summaries to {KNOWLEDGE_TABLE_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import re
+import unicodedata
+from pathlib import Path
+
+
+def normalize_text(text):
+    """
+    Folds differences that do not change what a summary prompt asks for:
+    Unicode form, line endings and runs of spaces or tabs.
+    """
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n")
+    return re.sub(r"[ \t]+", " ", text).strip()
+
+
+class SummaryStore:
+    """
+    Persistent memo of generated summaries keyed by a hash of the normalized
+    prompt and the prompt template version, so identical inputs are only
+    summarized once across batches, splits and runs. Entries are appended to
+    a JSONL file at `path`; without a path the store lives in memory only.
+    Bumping the template version invalidates every old entry.
+
+    Several processes may share the file: each batch is appended with a
+    single O_APPEND write, and the file is never rewritten.
+    """
+    def __init__(self, path=None):
+        self.path = Path(path) if path is not None else None
+        self._entries = {}
+        self._file = None
+        self._partial_tail = False
+        self.hits = 0
+        self.misses = 0
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._load()
+            self._file = open(self.path, "ab", buffering=0)
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        # An unterminated last line is another process's write in progress or
+        # a crashed one's remains; either way it is skipped, not truncated.
+        end = data.rfind(b"\n") + 1
+        self._partial_tail = end < len(data)
+        for line in data[:end].decode("utf-8", errors="replace").splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Remains of a crashed write, later terminated by another append.
+                continue
+            self._entries[record["key"]] = record["summary"]
+
+    @staticmethod
+    def key(prompt, version):
+        payload = f"{version}\n{normalize_text(prompt)}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        if key in self._entries:
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put_many(self, summaries):
+        """
+        Stores {key: summary} and appends the new entries to disk.
+        """
+        new = {k: v for k, v in summaries.items() if k not in self._entries}
+        self._entries.update(new)
+        if self._file is not None and new:
+            payload = "".join(json.dumps({"key": k, "summary": v}) + "\n" for k, v in new.items())
+            if self._partial_tail:
+                # Keep our first record off a crashed write's unterminated line.
+                payload = "\n" + payload
+                self._partial_tail = False
+            self._file.write(payload.encode("utf-8"))
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,140 @@
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from src.generation.checkpoint import atomic_write_jsonl
+
+# A lease not renewed for this long belongs to a dead worker and may be taken over.
+LEASE_SECONDS = 600
+
+
+class WorkQueue:
+    """
+    File-based work queue over named units, safe to share between processes
+    and machines on a common filesystem. A unit is claimed by creating
+    `<unit>.lease` exclusively and finished by atomically writing
+    `<unit>.jsonl`; a finished unit is never handed out again. Workers renew
+    their lease while they work, and a lease left untouched for
+    `lease_seconds` (a crashed worker) can be taken over.
+    """
+    def __init__(self, work_dir, units, lease_seconds=LEASE_SECONDS, worker_id=None):
+        self.work_dir = Path(work_dir)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.units = list(units)
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+
+    def output_path(self, unit):
+        return self.work_dir / f"{unit}.jsonl"
+
+    def _lease_path(self, unit):
+        return self.work_dir / f"{unit}.lease"
+
+    def done(self, unit):
+        return self.output_path(unit).exists()
+
+    def pending(self):
+        return [u for u in self.units if not self.done(u)]
+
+    def claim(self, unit):
+        """
+        Tries to take the lease on `unit`. Returns False if it is finished or
+        another live worker holds it.
+        """
+        if self.done(unit):
+            return False
+        lease = self._lease_path(unit)
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return self._take_over(unit)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.worker_id)
+        # The unit may have been finished between the check and the claim.
+        if self.done(unit):
+            self.release(unit)
+            return False
+        return True
+
+    def _take_over(self, unit):
+        lease = self._lease_path(unit)
+        try:
+            if time.time() - lease.stat().st_mtime < self.lease_seconds:
+                return False
+            # Only one worker can move the stale lease aside.
+            stale = lease.with_name(f"{lease.name}.{self.worker_id}")
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return False
+        if time.time() - stale.stat().st_mtime < self.lease_seconds:
+            # Another worker renewed or re-created it in the meantime: give it back.
+            try:
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        return self.claim(unit)
+
+    def claim_next(self):
+        for unit in self.units:
+            if self.claim(unit):
+                return unit
+        return None
+
+    def renew(self, unit):
+        try:
+            os.utime(self._lease_path(unit))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def heartbeat(self, unit, interval=None):
+        """
+        Renews the lease on `unit` from a background thread while the block
+        runs, for work with no natural point to call `renew` from.
+        """
+        interval = self.lease_seconds / 4 if interval is None else interval
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                self.renew(unit)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, unit):
+        try:
+            os.remove(self._lease_path(unit))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, unit, records):
+        if not self.done(unit):
+            atomic_write_jsonl(self.output_path(unit), records)
+        self.release(unit)
+
+    def read(self, unit):
+        with open(self.output_path(unit), "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def wait_for(self, unit, poll_seconds=10):
+        """
+        Blocks until `unit` is finished. Returns True instead if its worker
+        died and this one claimed it, in which case the caller must do it.
+        """
+        while not self.done(unit):
+            if self.claim(unit):
+                return True
+            time.sleep(poll_seconds)
+        return False
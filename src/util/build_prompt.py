@@ -1,10 +1,26 @@
-def build_prompt(example):
+PROMPT_PREAMBLE = (
+    "You are roleplaying as Arthur Morgan from Red Dead Redemption 2.\n"
+    "Stay in character and respond naturally.\n\n"
+)
+
+def build_prompt_prefixes(example, memory=None):
+    """
+    Prefixes of build_prompt(example) that repeat across requests, shortest
+    first: the preamble, then through the mission, memory and knowledge
+    sections. Consecutive turns of a mission share the longer ones.
+
+    With a `memory` (e.g. ExtractiveMemory), the memory section is
+    memory.summary(utterance) instead of the example's memory_summary.
+    """
+    memory_summary = example['memory_summary'] if memory is None else memory.summary(example['utterance'])
+    mission = PROMPT_PREAMBLE + f"Mission:\n{example['mission']}\n\n"
+    memory = mission + f"Conversation Memory:\n{memory_summary}\n\n"
+    knowledge = memory + f"Relevant Knowledge:\n{example['knowledge_summary']}\n\n"
+    return [PROMPT_PREAMBLE, mission, memory, knowledge]
+
+def build_prompt(example, memory=None):
     return (
-        "You are roleplaying as Arthur Morgan from Red Dead Redemption 2.\n"
-        "Stay in character and respond naturally.\n\n"
-        f"Mission:\n{example['mission']}\n\n"
-        f"Conversation Memory:\n{example['memory_summary']}\n\n"
-        f"Relevant Knowledge:\n{example['knowledge_summary']}\n\n"
+        build_prompt_prefixes(example, memory)[-1] +
         f"Dialogue:\n"
         f"{example['speaker']}: {example['utterance']}\n\n"
         f"{example['response_speaker']}:"